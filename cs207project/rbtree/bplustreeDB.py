@@ -0,0 +1,550 @@
+"""
+A copy-on-write B+tree database with the same interface as the red black tree DBDB.
+
+Every tree node is a fixed-size page of Storage.SUPERBLOCK_SIZE bytes stored at
+a page aligned address. Internal pages hold up to a few hundred keys and child
+addresses, leaves hold keys and their values inline, so a lookup reads one page
+per level and a range scan reads consecutive entries out of each leaf page.
+
+Like the red black tree, pages are never changed in place: a set copies the
+pages on the path from the root to the leaf, and changes are final only when
+committed.
+"""
+
+import os
+import pickle
+import struct
+from bisect import bisect_left, bisect_right
+
+from cs207project.rbtree.redblackDB import Storage, NodeCache, ValueRef, \
+    KEY_FLOAT, KEY_INT, KEY_PICKLED
+
+PAGE_SIZE = Storage.SUPERBLOCK_SIZE
+
+LEAF = 0
+INTERNAL = 1
+PAGE_HEADER = struct.Struct("!BBH")
+PICKLED_KEYS_LENGTH = struct.Struct("!I")
+
+# A page is split when it no longer fits. Capping the size of a single entry
+# guarantees that both halves of a split fit in a page again.
+MAX_ENTRY_SIZE = PAGE_SIZE // 4
+
+def _key_kind(keys):
+    "choose how to pack a list of keys"
+    if all(isinstance(key, float) for key in keys):
+        return KEY_FLOAT
+    if all(isinstance(key, int) and not isinstance(key, bool)
+           and -2**63 <= key < 2**63 for key in keys):
+        return KEY_INT
+    return KEY_PICKLED
+
+def _key_size(key):
+    "bytes a key takes up in a page"
+    if isinstance(key, (float, int)) and not isinstance(key, bool):
+        return 8
+    return len(pickle.dumps(key))
+
+class BPlusPage(object):
+    """
+    A B+tree page.
+
+    Parameters
+    ----------
+    keys : list
+        Sorted keys.
+    values : list of bytes
+        For leaf pages, the encoded value of each key.
+    children : list of BPlusPageRef
+        For internal pages, one more child than there are keys. Keys in
+        children[i] are >= keys[i - 1] and < keys[i].
+
+    Notes
+    -----
+    PRE: Exactly one of values and children is given.
+    WARNINGS: Pages are shared between versions of the tree; never modify one in place.
+    """
+
+    def __init__(self, keys, values=None, children=None):
+        self.keys = keys
+        self.values = values
+        self.children = children
+
+    @property
+    def is_leaf(self):
+        return self.children is None
+
+    def store_refs(self, storage):
+        """
+        Store all children of the page.
+        """
+        if not self.is_leaf:
+            for child in self.children:
+                child.store(storage)
+
+    def entry_sizes(self):
+        """
+        Approximate bytes used by each entry of the page.
+        """
+        if self.is_leaf:
+            return [_key_size(k) + 2 + len(v) for k, v in zip(self.keys, self.values)]
+        return [_key_size(k) + 8 for k in self.keys]
+
+    def split(self):
+        """
+        Split an overfull page in two halves of roughly equal size.
+
+        Returns
+        -------
+        (left page, separator key, right page)
+        """
+        sizes = self.entry_sizes()
+        half = sum(sizes) / 2
+        mid, total = 0, 0
+        while mid < len(sizes) - 1 and total + sizes[mid] < half:
+            total += sizes[mid]
+            mid += 1
+        if self.is_leaf:
+            mid = max(mid, 1)
+            left = BPlusPage(self.keys[:mid], values=self.values[:mid])
+            right = BPlusPage(self.keys[mid:], values=self.values[mid:])
+            return left, right.keys[0], right
+        # the middle key moves up to the parent, leaving a key on either side
+        mid = min(max(mid, 1), len(self.keys) - 2)
+        left = BPlusPage(self.keys[:mid], children=self.children[:mid + 1])
+        right = BPlusPage(self.keys[mid + 1:], children=self.children[mid + 1:])
+        return left, self.keys[mid], right
+
+class BPlusPageRef(ValueRef):
+    """
+    A class that stores a reference to a B+tree page on disk.
+
+    Notes
+    -----
+    PRE: storage is a PageStorage.
+    """
+
+    def prepare_to_store(self, storage):
+        """
+        Have a page store its children.
+        """
+        if self._referent:
+            self._referent.store_refs(storage)
+
+    def get(self, storage):
+        """
+        Read page from disk, going through the node cache of storage if it has one.
+
+        Parameters:
+        -----------
+        storage : storage object to read from.
+        """
+        if self._referent is None and self._address:
+            cache = storage.node_cache
+            if cache is None:
+                self._referent = self.bytes_to_referent(storage.read(self._address))
+                return self._referent
+            page = cache.get(self._address)
+            if page is None:
+                page = self.bytes_to_referent(storage.read(self._address))
+                cache.put(self._address, page, PAGE_SIZE)
+            return page
+        return self._referent
+
+    @staticmethod
+    def referent_to_bytes(referent):
+        """
+        Pack a page: header (page kind, key kind, key count), keys, then the
+        value lengths and values of a leaf or the child addresses of an internal page.
+        """
+        keys = referent.keys
+        n = len(keys)
+        kind = _key_kind(keys)
+        if kind == KEY_FLOAT:
+            packed_keys = struct.pack("!%dd" % n, *keys)
+        elif kind == KEY_INT:
+            packed_keys = struct.pack("!%dq" % n, *keys)
+        else:
+            pickled = pickle.dumps(keys)
+            packed_keys = PICKLED_KEYS_LENGTH.pack(len(pickled)) + pickled
+        if referent.is_leaf:
+            lengths = struct.pack("!%dH" % n, *[len(v) for v in referent.values])
+            body = lengths + b''.join(referent.values)
+            header = PAGE_HEADER.pack(LEAF, kind, n)
+        else:
+            body = struct.pack("!%dQ" % (n + 1), *[c.address for c in referent.children])
+            header = PAGE_HEADER.pack(INTERNAL, kind, n)
+        return header + packed_keys + body
+
+    @staticmethod
+    def bytes_to_referent(page):
+        """
+        Unpack a page.
+        """
+        page_kind, kind, n = PAGE_HEADER.unpack_from(page)
+        offset = PAGE_HEADER.size
+        if kind == KEY_FLOAT:
+            keys = list(struct.unpack_from("!%dd" % n, page, offset))
+            offset += 8 * n
+        elif kind == KEY_INT:
+            keys = list(struct.unpack_from("!%dq" % n, page, offset))
+            offset += 8 * n
+        else:
+            length = PICKLED_KEYS_LENGTH.unpack_from(page, offset)[0]
+            offset += PICKLED_KEYS_LENGTH.size
+            keys = pickle.loads(page[offset:offset + length])
+            offset += length
+        if page_kind == LEAF:
+            lengths = struct.unpack_from("!%dH" % n, page, offset)
+            offset += 2 * n
+            values = []
+            for length in lengths:
+                values.append(bytes(page[offset:offset + length]))
+                offset += length
+            return BPlusPage(keys, values=values)
+        addresses = struct.unpack_from("!%dQ" % (n + 1), page, offset)
+        return BPlusPage(keys, children=[BPlusPageRef(address=a) for a in addresses])
+
+class PageStorage(Storage):
+    """
+    Storage that reads and writes whole pages at page aligned addresses.
+
+    Notes
+    -----
+    PRE: The file only holds the superblock followed by pages.
+    """
+
+    def write(self, data):
+        "write a page to disk, returning the address at which you wrote it"
+        if len(data) > PAGE_SIZE:
+            raise ValueError("page of %d bytes does not fit in %d" % (len(data), PAGE_SIZE))
+        self.lock()
+        object_address = self._buffer_address + len(self._buffer)
+        self._buffer += data
+        self._buffer += b'\x00' * (PAGE_SIZE - len(data))
+        if len(self._buffer) >= self.buffer_bytes:
+            self.flush_buffer()
+        return object_address
+
+    def read(self, address):
+        if self._buffered(address):
+            offset = address - self._buffer_address
+            return bytes(self._buffer[offset:offset + PAGE_SIZE])
+        if self.use_mmap:
+            return self._mapped(address + PAGE_SIZE)[address:address + PAGE_SIZE]
+        self._f.seek(address)
+        return self._f.read(PAGE_SIZE)
+
+class BPlusTree(object):
+    """
+    A copy-on-write B+tree.
+
+    Parameters
+    ----------
+    storage : PageStorage
+
+    Notes
+    -----
+    PRE: Keys in a tree should all be of one type that has a notion of less/greater than.
+         Values are strings.
+    WARNINGS: A key and its value may take up at most MAX_ENTRY_SIZE bytes.
+    """
+
+    def __init__(self, storage):
+        self._storage = storage
+        self._refresh_tree_ref()
+
+    def commit(self):
+        """
+        Changes are final only when committed.
+        """
+        self._tree_ref.store(self._storage)
+        self._storage.commit_root_address(self._tree_ref.address)
+
+    def _refresh_tree_ref(self):
+        """
+        Get reference to new tree if it has changed.
+        """
+        self._tree_ref = BPlusPageRef(
+            address=self._storage.get_root_address())
+
+    def _follow(self, ref):
+        """
+        Get a page from a reference.
+        """
+        return ref.get(self._storage)
+
+    def _root(self):
+        """
+        Get the root page, refreshing the tree unless we hold the write lock.
+        """
+        if not self._storage.locked:
+            self._refresh_tree_ref()
+        return self._follow(self._tree_ref)
+
+    def get(self, key):
+        """
+        Get value for a key.
+
+        Raises:
+        -------
+            KeyError : if key is not in the tree.
+        """
+        page = self._root()
+        if page is None:
+            raise KeyError(key)
+        while not page.is_leaf:
+            page = self._follow(page.children[bisect_right(page.keys, key)])
+        i = bisect_left(page.keys, key)
+        if i < len(page.keys) and page.keys[i] == key:
+            return ValueRef.bytes_to_referent(page.values[i])
+        raise KeyError(key)
+
+    def get_many(self, keys):
+        """
+        Get values for many keys at once, in a single descent of the tree.
+        Each page on the way is read once and the sorted keys are split between its children.
+
+        Returns
+        -----------
+        dict mapping each key found in the tree to its value. Keys that are not
+        in the tree are left out.
+        """
+        keys = sorted(set(keys))
+        found = {}
+        root = self._root()
+        stack = [(root, 0, len(keys))] if root is not None and keys else []
+        while stack:
+            page, lo, hi = stack.pop()
+            if page.is_leaf:
+                for key in keys[lo:hi]:
+                    i = bisect_left(page.keys, key)
+                    if i < len(page.keys) and page.keys[i] == key:
+                        found[key] = ValueRef.bytes_to_referent(page.values[i])
+                continue
+            # keys[start:end] belong to children[i]
+            start = lo
+            for i, child in enumerate(page.children):
+                end = hi if i == len(page.keys) else bisect_left(keys, page.keys[i], start, hi)
+                if start < end:
+                    stack.append((self._follow(child), start, end))
+                start = end
+        return found
+
+    def set(self, key, value):
+        """
+        Set a new value in the tree, causing a new tree.
+        Try to lock the tree. If we succeed make sure we dont lose updates from any other process.
+
+        Raises:
+        -------
+            ValueError : if the key and value are too large to store in a page.
+        """
+        encoded = ValueRef.referent_to_bytes(value)
+        if _key_size(key) + 2 + len(encoded) > MAX_ENTRY_SIZE:
+            raise ValueError("entry for key %r is larger than %d bytes" % (key, MAX_ENTRY_SIZE))
+        if self._storage.lock():
+            self._refresh_tree_ref()
+        root = self._follow(self._tree_ref)
+        if root is None:
+            self._tree_ref = BPlusPageRef(BPlusPage([key], values=[encoded]))
+            return
+        new_root, split = self._insert(root, key, encoded)
+        if split is not None:
+            sep_key, right = split
+            new_root = BPlusPage([sep_key], children=[
+                BPlusPageRef(new_root), BPlusPageRef(right)])
+        self._tree_ref = BPlusPageRef(new_root)
+
+    def _insert(self, page, key, encoded):
+        """
+        Insert into the subtree under page, copying the pages on the way down.
+
+        Returns
+        -------
+        (new page, None) or (new left page, (separator key, new right page)) if the page split
+        """
+        if page.is_leaf:
+            keys, values = list(page.keys), list(page.values)
+            i = bisect_left(keys, key)
+            if i < len(keys) and keys[i] == key:
+                values[i] = encoded
+            else:
+                keys.insert(i, key)
+                values.insert(i, encoded)
+            new_page = BPlusPage(keys, values=values)
+        else:
+            i = bisect_right(page.keys, key)
+            child, split = self._insert(self._follow(page.children[i]), key, encoded)
+            keys, children = list(page.keys), list(page.children)
+            children[i] = BPlusPageRef(child)
+            if split is not None:
+                sep_key, right = split
+                keys.insert(i, sep_key)
+                children.insert(i + 1, BPlusPageRef(right))
+            new_page = BPlusPage(keys, children=children)
+        if len(BPlusPageRef.referent_to_bytes(new_page)) <= PAGE_SIZE:
+            return new_page, None
+        left, sep_key, right = new_page.split()
+        return left, (sep_key, right)
+
+    def get_min(self):
+        """
+        Get value of the smallest key in the tree.
+
+        Raises:
+        -------
+            KeyError : if the tree is empty.
+        """
+        for key, value in self.range():
+            return value
+        raise KeyError
+
+    def chop(self, chop_key):
+        """
+        Get all key-value pairs with key <= chop_key, in ascending key order.
+        """
+        return list(self.range(hi=chop_key))
+
+    def range(self, lo=None, hi=None, reverse=False):
+        """
+        Iterate over key-value pairs with lo <= key <= hi without building a list.
+
+        Parameters:
+        -----------
+        lo : lower bound on keys (inclusive). None for no lower bound.
+        hi : upper bound on keys (inclusive). None for no upper bound.
+        reverse : if True yield keys in descending order.
+
+        Returns
+        -----------
+        generator of (key, value) tuples in key order
+        """
+        root = self._root()
+        return ((key, ValueRef.bytes_to_referent(value))
+                for key, value in self._iter_entries(root, lo, hi, reverse))
+
+    def _iter_entries(self, page, lo, hi, reverse):
+        """
+        Yield (key, encoded value) for lo <= key <= hi, one leaf page after the other.
+
+        The first descent heads for the starting bound; after that the cursor
+        keeps a stack of internal pages and moves to the neighbouring leaf
+        through the lowest ancestor that has one.
+        """
+        if page is None:
+            return
+        step = -1 if reverse else 1
+        start_key = hi if reverse else lo
+        stack = []
+        while True:
+            while not page.is_leaf:
+                if start_key is None:
+                    i = len(page.children) - 1 if reverse else 0
+                else:
+                    i = bisect_right(page.keys, start_key)
+                stack.append([page, i])
+                page = self._follow(page.children[i])
+            keys = page.keys
+            if start_key is None:
+                i = len(keys) - 1 if reverse else 0
+            elif reverse:
+                i = bisect_right(keys, start_key) - 1
+            else:
+                i = bisect_left(keys, start_key)
+            while 0 <= i < len(keys):
+                key = keys[i]
+                if reverse and lo is not None and key < lo:
+                    return
+                if not reverse and hi is not None and key > hi:
+                    return
+                yield key, page.values[i]
+                i += step
+            start_key = None
+            # move to the next leaf
+            while stack:
+                parent, i = stack[-1]
+                i += step
+                if 0 <= i < len(parent.children):
+                    stack[-1][1] = i
+                    page = self._follow(parent.children[i])
+                    break
+                stack.pop()
+            else:
+                return
+
+class DBDB(object):
+
+    # documentation for parallel methods in BPlusTree() class.
+    def __init__(self, f, node_cache=None, use_mmap=False, path=None):
+        self._storage = PageStorage(f, node_cache, use_mmap, path)
+        self._tree = BPlusTree(self._storage)
+
+    def _assert_not_closed(self):
+        if self._storage.closed:
+            raise ValueError('Database closed.')
+
+    def close(self):
+        self._storage.close()
+
+    def commit(self):
+        self._assert_not_closed()
+        self._tree.commit()
+
+    def get(self, key):
+        self._assert_not_closed()
+        return self._tree.get(key)
+
+    def get_many(self, keys):
+        self._assert_not_closed()
+        return self._tree.get_many(keys)
+
+    def set(self, key, value):
+        self._assert_not_closed()
+        return self._tree.set(key, value)
+
+    def get_min(self):
+        self._assert_not_closed()
+        return self._tree.get_min()
+
+    def chop(self, chop_key):
+        self._assert_not_closed()
+        return self._tree.chop(chop_key)
+
+    def range(self, lo=None, hi=None, reverse=False):
+        self._assert_not_closed()
+        return self._tree.range(lo, hi, reverse)
+
+    def cache_info(self):
+        """
+        Returns hit/miss counters and size of the page cache, or None if caching is off.
+        """
+        if self._storage.node_cache is None:
+            return None
+        return self._storage.node_cache.info()
+
+def connect(dbname, cache_size=None, cache_bytes=None, use_mmap=False):
+    """
+    Open (or create) a B+tree database file.
+
+    Parameters
+    ----------
+    dbname : string
+        Path of the database file.
+    cache_size : int
+        Keep up to this many decoded pages in an LRU cache. Optional.
+    cache_bytes : int
+        Keep up to this many bytes of pages in an LRU cache. Optional.
+    use_mmap : bool
+        Read pages through a memory map of the file. Defaults to False.
+    """
+    try:
+        f = open(dbname, 'r+b')
+    except IOError:
+        fd = os.open(dbname, os.O_RDWR | os.O_CREAT)
+        f = os.fdopen(fd, 'r+b')
+    node_cache = None
+    if cache_size is not None or cache_bytes is not None:
+        node_cache = NodeCache(cache_size, cache_bytes)
+    # an absolute path, so a later os.chdir() does not look like a replaced file
+    return DBDB(f, node_cache, use_mmap, os.path.abspath(dbname))
@@ -1,8 +1,49 @@
 import pickle
 import os
+import math
+import zlib
+import mmap
 import struct
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from itertools import islice
+from contextlib import contextmanager
+from functools import wraps
 import portalocker
 
+# Binary node records: format byte, key type byte, key, then the left, value
+# and right addresses and the color. Pickled records (the original format)
+# always start with the pickle PROTO opcode, which is never a format byte.
+# Counted records also hold the number of nodes under the left and right child.
+# If the VALUE_INLINE bit of the key type byte is set, the value address holds
+# the length of the value, whose bytes follow the fixed-width part of the record.
+NODE_FORMAT = 1
+NODE_COUNTED_FORMAT = 2
+KEY_FLOAT = 0
+KEY_INT = 1
+KEY_PICKLED = 2
+VALUE_INLINE = 0x80
+NODE_FLOAT_KEY = struct.Struct("!BBdQQQB")
+NODE_INT_KEY = struct.Struct("!BBqQQQB")
+NODE_PICKLED_KEY = struct.Struct("!BBQQQB")
+NODE_COUNTED_FLOAT_KEY = struct.Struct("!BBdQQQBQQ")
+NODE_COUNTED_INT_KEY = struct.Struct("!BBqQQQBQQ")
+NODE_COUNTED_PICKLED_KEY = struct.Struct("!BBQQQBQQ")
+PICKLE_PROTO = b'\x80'
+
+# How far commit_root_address() goes to get a commit onto disk:
+#   none  - no flushes of our own; the data reaches the OS when the lock is released
+#   flush - flush the data, then write and flush the root (the original behaviour)
+#   fsync - fsync the data, then write and fsync the root
+#   group - publish each root like flush, and release the lock, but fsync only
+#           once a time or size window has passed, with one fsync for all the
+#           commits made in it (by any connection, as fsync covers the whole file).
+#           The superblock keeps the last fsynced root, and a crc32 of everything
+#           appended since; if those bytes did not all reach the disk (e.g. after
+#           an OS crash), the next connect falls back to that root.
+DURABILITY_MODES = ('none', 'flush', 'fsync', 'group')
+
 class ValueRef(object):
     """
     A class that stores a reference to a string value on disk
@@ -68,12 +109,27 @@ class RedBlackNodeRef(ValueRef):
 
     Parameters
     ----------
+    referent : RedBlackNode
+        The node to store. Optional.
+    address : int
+        Address to store at; defaults to 0. Optional.
+    count : int
+        Number of nodes in the subtree, if known without reading it. Optional.
 
     Notes
     -----
-    PRE:
-    WARNINGS:
+    PRE: The count is taken from the referent when one is given, and is 0 for
+         an empty reference.
+    WARNINGS: count is None for subtrees read from records without counts.
     """
+    def __init__(self, referent=None, address=0, count=None):
+        super(RedBlackNodeRef, self).__init__(referent, address)
+        if count is None:
+            if referent is not None:
+                count = referent.size
+            elif not address:
+                count = 0
+        self.count = count
     
     def prepare_to_store(self, storage):
         """
@@ -82,33 +138,132 @@ class RedBlackNodeRef(ValueRef):
         if self._referent:
             self._referent.store_refs(storage)
 
+    def get(self, storage):
+        """
+        Read node from disk, going through the node cache of storage if it has one.
+        Nodes served by the cache are not kept on the reference, so the cache
+        alone bounds how many decoded nodes stay in memory.
+
+        Parameters:
+        -----------
+        storage : storage object to read from.
+        """
+        if self._referent is None and self._address:
+            cache = storage.node_cache
+            if cache is None:
+                if storage.stats is not None:
+                    storage.stats.count('node_decodes')
+                self._referent = self.bytes_to_referent(storage.read(self._address))
+                return self._referent
+            node = cache.get(self._address)
+            if node is None:
+                if storage.stats is not None:
+                    storage.stats.count('node_decodes')
+                data = storage.read(self._address)
+                node = self.bytes_to_referent(data)
+                cache.put(self._address, node, len(data))
+            return node
+        return self._referent
+
     @staticmethod
     def referent_to_bytes(referent):
         """
-        Use pickle to convert node to bytes.
+        Pack a node into a fixed-width binary record.
+
+        Float and 64-bit int keys are packed inline next to the left, value
+        and right addresses and the color byte. Any other key type is
+        pickled and appended after the fixed-width part of the record.
+        The subtree counts of both children follow the color byte, unless
+        one of them is not known. A value that was not stored on its own
+        (see RedBlackNode.store_refs) is put in the record after them.
         """
-        return pickle.dumps({
-            'left': referent.left_ref.address,
-            'key': referent.key,
-            'value': referent.value_ref.address,
-            'right': referent.right_ref.address,
-            'color': referent.color
-        })
+        key = referent.key
+        value_ref = referent.value_ref
+        if value_ref.address or value_ref._referent is None:
+            flags, value_field, value_bytes = 0, value_ref.address, b''
+        else:
+            value_bytes = value_ref.referent_to_bytes(value_ref._referent)
+            flags, value_field = VALUE_INLINE, len(value_bytes)
+        fields = (referent.left_ref.address, value_field,
+                  referent.right_ref.address, referent.color)
+        if referent.size is None:
+            fmt = NODE_FORMAT
+            float_key, int_key, pickled_key = NODE_FLOAT_KEY, NODE_INT_KEY, NODE_PICKLED_KEY
+        else:
+            fmt = NODE_COUNTED_FORMAT
+            float_key, int_key, pickled_key = (NODE_COUNTED_FLOAT_KEY,
+                NODE_COUNTED_INT_KEY, NODE_COUNTED_PICKLED_KEY)
+            fields += (referent.left_ref.count, referent.right_ref.count)
+        if isinstance(key, float):
+            return float_key.pack(fmt, KEY_FLOAT | flags, key, *fields) + value_bytes
+        if (isinstance(key, int) and not isinstance(key, bool)
+                and -2**63 <= key < 2**63):
+            return int_key.pack(fmt, KEY_INT | flags, key, *fields) + value_bytes
+        return (pickled_key.pack(fmt, KEY_PICKLED | flags, *fields) + value_bytes
+                + pickle.dumps(key))
 
     @staticmethod
     def bytes_to_referent(string):
         """
-        Unpickle bytes to get a node object.
+        Unpack bytes to get a node object.
+        Records written in the original pickled format are still readable.
         """
-        d = pickle.loads(string)
+        if string[:1] == PICKLE_PROTO:
+            d = pickle.loads(string)
+            return RedBlackNode(
+                RedBlackNodeRef(address=d['left']),
+                d['key'],
+                ValueRef(address=d['value']),
+                RedBlackNodeRef(address=d['right']),
+                d['color']
+            )
+        fmt, kind = string[0], string[1] & ~VALUE_INLINE
+        if fmt == NODE_FORMAT:
+            left_count = right_count = None
+            if kind == KEY_FLOAT:
+                layout = NODE_FLOAT_KEY
+                _, _, key, left, value, right, color = layout.unpack_from(string)
+            elif kind == KEY_INT:
+                layout = NODE_INT_KEY
+                _, _, key, left, value, right, color = layout.unpack_from(string)
+            elif kind == KEY_PICKLED:
+                layout = NODE_PICKLED_KEY
+                _, _, left, value, right, color = layout.unpack_from(string)
+            else:
+                raise ValueError("Unknown node key type %d" % kind)
+        elif fmt == NODE_COUNTED_FORMAT:
+            if kind == KEY_FLOAT:
+                layout = NODE_COUNTED_FLOAT_KEY
+                (_, _, key, left, value, right, color,
+                 left_count, right_count) = layout.unpack_from(string)
+            elif kind == KEY_INT:
+                layout = NODE_COUNTED_INT_KEY
+                (_, _, key, left, value, right, color,
+                 left_count, right_count) = layout.unpack_from(string)
+            elif kind == KEY_PICKLED:
+                layout = NODE_COUNTED_PICKLED_KEY
+                (_, _, left, value, right, color,
+                 left_count, right_count) = layout.unpack_from(string)
+            else:
+                raise ValueError("Unknown node key type %d" % kind)
+        else:
+            raise ValueError("Unknown node format %d" % fmt)
+        offset = layout.size
+        if string[1] & VALUE_INLINE:
+            value_ref = ValueRef(ValueRef.bytes_to_referent(string[offset:offset + value]))
+            offset += value
+        else:
+            value_ref = ValueRef(address=value)
+        if kind == KEY_PICKLED:
+            key = pickle.loads(string[offset:])
         return RedBlackNode(
-            RedBlackNodeRef(address=d['left']),
-            d['key'],
-            ValueRef(address=d['value']),
-            RedBlackNodeRef(address=d['right']),
-            d['color']
+            RedBlackNodeRef(address=left, count=left_count),
+            key,
+            value_ref,
+            RedBlackNodeRef(address=right, count=right_count),
+            color
         )
-    
+
 class RedBlackNode:
     """
     A red black node.
@@ -128,7 +283,8 @@ class RedBlackNode:
 
     Notes
     -----
-    PRE:
+    PRE: size, the number of nodes in the subtree rooted here, is None
+         if the count of either child is not known.
     WARNINGS:
     """
 
@@ -138,6 +294,10 @@ class RedBlackNode:
         self.value_ref = value_ref
         self.right_ref = right_ref
         self.color = color
+        if left_ref.count is None or right_ref.count is None:
+            self.size = None
+        else:
+            self.size = left_ref.count + right_ref.count + 1
 
     @classmethod
     def from_node(cls, node, **kwargs):
@@ -155,8 +315,13 @@ class RedBlackNode:
     def store_refs(self, storage):
         """
         Method for a node to store all of its stuff.
+        Values of at most storage.inline_values bytes are not stored on their
+        own but kept in the node record, so reading the node reads the value.
         """
-        self.value_ref.store(storage)
+        value_ref = self.value_ref
+        if (value_ref.address or value_ref._referent is None or
+                len(value_ref.referent_to_bytes(value_ref._referent)) > storage.inline_values):
+            value_ref.store(storage)
         self.left_ref.store(storage)
         self.right_ref.store(storage)
 
@@ -193,29 +358,81 @@ class RedBlackTree:
 
     Parameters
     ----------
+    storage : Storage
+    root_address : int
+        Pin the tree to the root committed at this address. Optional.
+        A pinned tree never refreshes, so it keeps showing that commit.
 
     Notes
     -----
-    PRE:
+    PRE: Uncommitted changes live in memory only. Writers take the file lock
+         just for the commit; if another writer committed in the meantime, the
+         uncommitted sets are replayed on top of its tree before writing.
     WARNINGS:
     """
-    def __init__(self, storage):
+    def __init__(self, storage, root_address=None):
         self._storage = storage
-        self._refresh_tree_ref()
+        self._pinned = root_address is not None
+        self._pending = [] # uncommitted (key, value_ref) sets, for replaying
+        self._dirty = False
+        if self._pinned:
+            self._tree_ref = RedBlackNodeRef(address=root_address)
+            self._base_address = root_address
+        else:
+            self._refresh_tree_ref()
 
     def commit(self):
         """
         Changes are final only when committed.
+        The file is only locked while the new nodes and the root are written,
+        and the new nodes are appended to the file in one write.
         """
-        self._tree_ref.store(self._storage)
+        self._lock()
+        try:
+            self._tree_ref.store(self._storage)
+        except BaseException:
+            self._storage.discard_buffer()
+            self._storage.unlock()
+            raise
         self._storage.commit_root_address(self._tree_ref.address)
+        self._base_address = self._tree_ref.address
+        self._pending = []
+        self._dirty = False
+
+    def rollback(self):
+        """
+        Throw away all changes made since the last commit.
+        """
+        self._storage.discard_buffer()
+        self._storage.unlock()
+        self._pending = []
+        self._dirty = False
+        self._refresh_tree_ref()
+
+    def _lock(self):
+        """
+        Take the write lock. If another writer committed since our tree was
+        read, rebuild our uncommitted sets on top of its tree so they are not lost.
+        """
+        if self._storage.lock() and self._storage.get_root_address() != self._base_address:
+            self._refresh_tree_ref()
+            for key, value_ref in self._pending:
+                self._tree_ref = self.insert(self._follow(self._tree_ref), key, value_ref)
 
     def _refresh_tree_ref(self):
         """
         Get reference to new tree if it has changed.
         """
-        self._tree_ref = RedBlackNodeRef(
-            address=self._storage.get_root_address())
+        self._base_address = self._storage.get_root_address()
+        self._tree_ref = RedBlackNodeRef(address=self._base_address)
+
+    def _refresh_if_clean(self):
+        """
+        Pick up commits by other writers, unless we have uncommitted changes
+        of our own (which we want to keep reading) or the tree is pinned.
+        """
+        if not self._dirty and not self._pinned:
+            self._refresh_tree_ref()
 
     def get(self, key):
         """
@@ -231,22 +448,62 @@ class RedBlackTree:
         -------
             KeyError : if user searches for a key not in the RBT.
         """
-        if not self._storage.locked:
-            self._refresh_tree_ref()
+        self._refresh_if_clean()
+        stats = self._storage.stats
+        depth = 0
         node = self._follow(self._tree_ref)
         while node is not None:
+            depth += 1
             if key < node.key:
                 node = self.left(node)
             elif key > node.key:
                 node = self.right(node)
             else:
+                if stats is not None:
+                    stats.record_depth(depth)
                 return self.value(node)
+        if stats is not None:
+            stats.record_depth(depth)
         raise KeyError
+
+    def get_many(self, keys):
+        """
+        Get values for many keys at once.
+        The keys are sorted and resolved in a single descent of the tree: each
+        node on the way is read once, and the keys are split between its left
+        and right subtree instead of walking from the root for every key.
+
+        Parameters:
+        -----------
+        keys : iterable of keys to fetch.
+
+        Returns
+        -----------
+        dict mapping each key found in the tree to its value. Keys that are not
+        in the tree are left out.
+        """
+        self._refresh_if_clean()
+        keys = sorted(set(keys))
+        found = {}
+        stack = [(self._follow(self._tree_ref), 0, len(keys))]
+        while stack:
+            node, lo, hi = stack.pop()
+            if node is None:
+                continue
+            i = j = bisect_left(keys, node.key, lo, hi)
+            if i < hi and keys[i] == node.key:
+                found[keys[i]] = self.value(node)
+                j = i + 1
+            if lo < i:
+                stack.append((self.left(node), lo, i))
+            if j < hi:
+                stack.append((self.right(node), j, hi))
+        return found
     
     def set(self, key, value):
         """
         Set a new value in the tree, causing a new tree.
-        Try to lock the tree. If we succeed make sure we dont lose updates from any other process.
+        No lock is taken; the change is kept in memory until commit().
 
         Parameters:
         -----------
@@ -255,11 +512,74 @@ class RedBlackTree:
         value : e.g. int, string. 
 
         """
-        if self._storage.lock():
-            self._refresh_tree_ref()
+        self._refresh_if_clean()
         node = self._follow(self._tree_ref)
         value_ref = ValueRef(value)
         self._tree_ref = self.insert(node, key, value_ref)
+        self._pending.append((key, value_ref))
+        self._dirty = True
+
+    def bulk_load(self, sorted_items):
+        """
+        Build a balanced tree from key-value pairs sorted by key.
+        Keys already in the tree are merged in; for duplicate keys the last
+        value given wins, as with repeated calls to set().
+        Nodes are written bottom up in a single pass, each one as soon as both
+        of its children are written. Like set(), call commit() to make it final.
+        The tree stays locked from here until that commit.
+
+        Parameters:
+        -----------
+        sorted_items : iterable of (key, value) in ascending key order.
+
+        Raises:
+        -------
+            ValueError : if sorted_items is not sorted by key.
+        """
+        self._refresh_if_clean()
+        self._lock()
+        self._dirty = True
+        new_items = []
+        for key, value in sorted_items:
+            if new_items and key < new_items[-1][0]:
+                raise ValueError("bulk_load requires items sorted by key")
+            if new_items and key == new_items[-1][0]:
+                new_items.pop()
+            new_items.append((key, ValueRef(value)))
+
+        # merge with the (sorted) nodes already in the tree
+        entries = []
+        i = 0
+        for node in self._iter_in_order(self._follow(self._tree_ref)):
+            while i < len(new_items) and new_items[i][0] < node.key:
+                entries.append(new_items[i])
+                i += 1
+            if i < len(new_items) and new_items[i][0] == node.key:
+                continue
+            entries.append((node.key, node.value_ref))
+        entries.extend(new_items[i:])
+
+        # Splitting on the middle item keeps all leaves within one level of
+        # each other. If the bottom level is not full its nodes are colored red
+        # and everything else black, so every path has the same black height.
+        n = len(entries)
+        bottom = n.bit_length() - 1
+        bottom_color = Color.BLACK if (n + 1) & n == 0 else Color.RED
+
+        def build(lo, hi, depth):
+            if lo >= hi:
+                return RedBlackNodeRef()
+            mid = (lo + hi) // 2
+            left_ref = build(lo, mid, depth + 1)
+            right_ref = build(mid + 1, hi, depth + 1)
+            key, value_ref = entries[mid]
+            color = bottom_color if depth == bottom else Color.BLACK
+            ref = RedBlackNodeRef(RedBlackNode(left_ref, key, value_ref, right_ref, color))
+            ref.store(self._storage)
+            # drop the in-memory node so only the current path is kept around
+            return RedBlackNodeRef(address=ref.address, count=ref.count)
+
+        self._tree_ref = build(0, n, 0)
 
     def value(self, node):
         """
@@ -286,29 +606,42 @@ class RedBlackTree:
         ii. BALANCE. Minimize worst case depth of the tree. If RBT balance conditions
             are violated, trigger ROTATE_LEFT, ROTATE_RIGHT and RECOLOR as appropriate.
 
+        Walks down to the key recording the path, then copies and balances
+        the nodes on the path bottom up, without recursion.
+
         Parameters:
         -----------
 
         """
+        path = []
+        while node is not None:
+            if key < node.key:
+                path.append((node, True))
+                node = self.left(node)
+            elif node.key < key:
+                path.append((node, False))
+                node = self.right(node)
+            else:
+                break
         if node is None:
-            return RedBlackNodeRef(self.balance(RedBlackNode(
+            new_ref = RedBlackNodeRef(self.balance(RedBlackNode(
                 RedBlackNodeRef(), 
                 key, 
                 value_ref, 
                 RedBlackNodeRef(), 
                 Color.RED)))
-        elif key < node.key:
-            return RedBlackNodeRef(self.balance(RedBlackNode.from_node(
-                node,
-                left_ref=self.update(self.left(node), key, value_ref))))
-        elif node.key < key:
-            return RedBlackNodeRef(self.balance(RedBlackNode.from_node(
-                node,
-                right_ref=self.update(self.right(node), key, value_ref))))
-        elif key==node.key:
+        else:
             # handling duplicates
-            return RedBlackNodeRef(self.balance(RedBlackNode.from_node(
+            new_ref = RedBlackNodeRef(self.balance(RedBlackNode.from_node(
                 node, value_ref=value_ref)))
+        for parent, went_left in reversed(path):
+            if went_left:
+                new_ref = RedBlackNodeRef(self.balance(RedBlackNode.from_node(
+                    parent, left_ref=new_ref)))
+            else:
+                new_ref = RedBlackNodeRef(self.balance(RedBlackNode.from_node(
+                    parent, right_ref=new_ref)))
+        return new_ref
 
     def rotate_left(self, node):
         """
@@ -419,6 +752,7 @@ class RedBlackTree:
         """
         Get minimum value in a tree.
         """
+        self._refresh_if_clean()
         node = self._follow(self._tree_ref)
         while True:
             next_node = self.left(node)
@@ -431,8 +765,7 @@ class RedBlackTree:
         Implementation parallels get().
         Get key-value pair left of a *key*.
         """
-        if not self._storage.locked:
-            self._refresh_tree_ref()
+        self._refresh_if_clean()
         node = self._follow(self._tree_ref)
         while node is not None:
             if key < node.key:
@@ -449,8 +782,7 @@ class RedBlackTree:
         Implementation parallels get().
         Get key-value pair right of a *key*.
         """
-        if not self._storage.locked:
-            self._refresh_tree_ref()
+        self._refresh_if_clean()
         node = self._follow(self._tree_ref)
         while node is not None:
             if key < node.key:
@@ -462,6 +794,20 @@ class RedBlackTree:
                 return (node_right.key, self.value(node_right))
         raise KeyError
 
+    def _iter_in_order(self, node):
+        """
+        Yield the nodes of the subtree under node in key order, using an explicit stack.
+        """
+        stack = []
+        while stack or node is not None:
+            if node is not None:
+                stack.append(node)
+                node = self.left(node)
+            else:
+                node = stack.pop()
+                yield node
+                node = self.right(node)
+
     def traverse_in_order(self, node):
         """
         Traverse the children of a node returning visited nodes in a list.
@@ -474,15 +820,7 @@ class RedBlackTree:
         -----------
         out_global : list of nodes in subtree
         """
-        out_global = []
-        def traverse_enclosed(node):
-            if node is None:
-                return
-            traverse_enclosed(self.left(node))
-            out_global.append((node.key, self.value(node)))
-            traverse_enclosed(self.right(node))
-        traverse_enclosed(node)
-        return out_global
+        return [(node.key, self.value(node)) for node in self._iter_in_order(node)]
 
     def chop(self, chop_key):
         """
@@ -495,8 +833,7 @@ class RedBlackTree:
         """
         # returns a list of key-vals with key's less than or equal to chop_key
         nodes_to_expand = []
-        if not self._storage.locked:
-            self._refresh_tree_ref()
+        self._refresh_if_clean()
         node = self._follow(self._tree_ref)
         #traverse until you find appropriate node
         while node is not None:
@@ -518,17 +855,347 @@ class RedBlackTree:
         for node in nodes_to_expand:
             if node.key<=chop_key:
                 out.append((node.key, self.value(node)))
-            out = out + self.traverse_in_order(self.left(node))
+            out.extend(self.traverse_in_order(self.left(node)))
         return out
 
+    def range(self, lo=None, hi=None, reverse=False):
+        """
+        Iterate over key-value pairs with lo <= key <= hi without building a list.
+        e.g. range(4, 8) yields (4, 'four'), (6, 'six'), (7, 'seven'), (8, 'eight').
+
+        Parameters:
+        -----------
+        lo : lower bound on keys (inclusive). None for no lower bound.
+        hi : upper bound on keys (inclusive). None for no upper bound.
+        reverse : if True yield keys in descending order.
+
+        Returns
+        -----------
+        generator of (key, value) tuples in key order
+        """
+        self._refresh_if_clean()
+        nodes = self._iter_range(self._follow(self._tree_ref), lo, hi, reverse)
+        return ((node.key, self.value(node)) for node in nodes)
+
+    def _count(self, ref):
+        """
+        Number of nodes in the subtree of ref. Subtrees read from records
+        without counts are counted by walking them.
+        """
+        if ref.count is not None:
+            return ref.count
+        node = self._follow(ref)
+        if node.size is not None:
+            return node.size
+        return sum(1 for _ in self._iter_in_order(node))
+
+    def _rank(self, key, inclusive):
+        """
+        Number of keys less than key, or less than or equal to it if inclusive.
+        Adds up the left subtree counts on the path down to key.
+        """
+        rank = 0
+        node = self._follow(self._tree_ref)
+        while node is not None:
+            if node.key < key or (inclusive and node.key == key):
+                rank += self._count(node.left_ref) + 1
+                node = self.right(node)
+            else:
+                node = self.left(node)
+        return rank
+
+    def count_range(self, lo=None, hi=None):
+        """
+        Count the keys with lo <= key <= hi, like len(list(range(lo, hi))) but
+        reading only the node records on the paths to lo and hi.
+
+        Parameters:
+        -----------
+        lo : lower bound on keys (inclusive). None for no lower bound.
+        hi : upper bound on keys (inclusive). None for no upper bound.
+        """
+        self._refresh_if_clean()
+        if hi is None:
+            count = self._count(self._tree_ref)
+        else:
+            count = self._rank(hi, True)
+        if lo is not None:
+            count -= self._rank(lo, False)
+        return max(count, 0)
+
+    def nearest_keys(self, key, k):
+        """
+        Find the k keys closest to key, nearest first, by walking outward
+        from key in both directions. No value records are read.
+
+        Parameters:
+        -----------
+        key : number. Keys must support subtraction to measure closeness.
+        k : maximum number of keys to return.
+
+        Returns
+        -----------
+        list of keys, in order of increasing distance from key
+        """
+        self._refresh_if_clean()
+        return [node.key for node in islice(self._iter_nearest(key), k)]
+
+    def iter_nearest(self, key):
+        """
+        Iterate over key-value pairs in order of increasing distance of their
+        keys from key, without building a list. Only the nodes consumed so far
+        (and the paths down to them) are read, so callers can stop early.
+
+        Parameters:
+        -----------
+        key : number. Keys must support subtraction to measure closeness.
+
+        Returns
+        -----------
+        generator of (key, value) tuples, nearest first
+        """
+        self._refresh_if_clean()
+        return ((node.key, self.value(node)) for node in self._iter_nearest(key))
+
+    def _iter_nearest(self, key):
+        """
+        Yield nodes in order of increasing distance from key, merging a cursor
+        walking up from key with one walking down from it. Ties go to the larger key.
+        """
+        root = self._follow(self._tree_ref)
+        above = self._iter_range(root, key, None, False)
+        below = (node for node in self._iter_range(root, None, key, True) if node.key < key)
+        a, b = next(above, None), next(below, None)
+        while a is not None or b is not None:
+            if b is None or (a is not None and a.key - key <= key - b.key):
+                yield a
+                a = next(above, None)
+            else:
+                yield b
+                b = next(below, None)
+
+    def live_bytes(self):
+        """
+        Count the bytes on disk used by the committed tree, including the superblock.
+        Walks node records without decoding any values.
+        """
+        storage = self._storage
+        total = storage.SUPERBLOCK_SIZE
+        root_address = storage.get_root_address()
+        stack = [root_address] if root_address else []
+        while stack:
+            data = storage.read(stack.pop())
+            total += storage.INTEGER_LENGTH + len(data)
+            node = RedBlackNodeRef.bytes_to_referent(data)
+            if node.value_ref.address:
+                total += storage.INTEGER_LENGTH + len(storage.read(node.value_ref.address))
+            for ref in (node.left_ref, node.right_ref):
+                if ref.address:
+                    stack.append(ref.address)
+        return total
+
+    def _iter_range(self, node, lo, hi, reverse):
+        """
+        Yield nodes with lo <= key <= hi under node, walking the tree with an explicit stack.
+        Subtrees that lie entirely outside of the bounds are never read.
+        """
+        # walking in reverse is walking forward with the children swapped
+        if reverse:
+            near, far = self.right, self.left
+            before = lambda key: hi is not None and key > hi
+            past = lambda key: lo is not None and key < lo
+        else:
+            near, far = self.left, self.right
+            before = lambda key: lo is not None and key < lo
+            past = lambda key: hi is not None and key > hi
+        stack = []
+        while stack or node is not None:
+            if node is not None:
+                if before(node.key):
+                    # node and everything on its near side are out of range
+                    node = far(node)
+                else:
+                    stack.append(node)
+                    node = near(node)
+            else:
+                node = stack.pop()
+                if past(node.key):
+                    return
+                yield node
+                node = far(node)
+
+class NodeCache(object):
+    """
+    A least recently used cache of decoded nodes keyed by their disk address.
+
+    Parameters
+    ----------
+    max_nodes : int
+        Maximum number of nodes to keep. Optional.
+    max_bytes : int
+        Maximum total size of the cached node records on disk. Optional.
+
+    Notes
+    -----
+    PRE: Storage only ever appends, so the node at an address never changes and
+         cached nodes stay valid across tree refreshes and commits. The one
+         exception is a discarded append buffer, see discard_from().
+    WARNINGS: Do not share a cache between files.
+    """
+    def __init__(self, max_nodes=None, max_bytes=None):
+        self.max_nodes = max_nodes
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._nodes = OrderedDict()
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def get(self, address):
+        """
+        Get the node stored at address, or None on a miss.
+        """
+        try:
+            node, _ = self._nodes[address]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._nodes.move_to_end(address)
+        self.hits += 1
+        return node
+
+    def put(self, address, node, nbytes):
+        """
+        Add a node to the cache, evicting least recently used nodes if needed.
+        """
+        if address in self._nodes:
+            return
+        self._nodes[address] = (node, nbytes)
+        self.nbytes += nbytes
+        while self._nodes and (
+                (self.max_nodes is not None and len(self._nodes) > self.max_nodes) or
+                (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+            _, (_, evicted_bytes) = self._nodes.popitem(last=False)
+            self.nbytes -= evicted_bytes
+
+    def clear(self):
+        self._nodes.clear()
+        self.nbytes = 0
+
+    def discard_from(self, address):
+        """
+        Drop all nodes stored at or past address, e.g. records that were never
+        written to the file, whose addresses will be handed out again.
+        """
+        for stale in [a for a in self._nodes if a >= address]:
+            _, nbytes = self._nodes.pop(stale)
+            self.nbytes -= nbytes
+
+    def info(self):
+        """
+        Return cache counters and limits as a dict.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'nodes': len(self._nodes),
+            'bytes': self.nbytes,
+            'max_nodes': self.max_nodes,
+            'max_bytes': self.max_bytes,
+        }
+
+class Stats(object):
+    """
+    Counters and latency histograms for one connection to a database.
+
+    Notes
+    -----
+    PRE: Latencies are bucketed by powers of two microseconds: the bucket for
+         an operation is the smallest power of two that is at least its
+         duration, so bucket 1 holds everything up to 1 microsecond.
+         lock_waits counts only the locks that were held by another connection,
+         and lock_wait_seconds the time spent waiting for them.
+    WARNINGS: range() returns a generator, so it is not timed.
+    """
+    COUNTERS = ('node_decodes', 'reads', 'bytes_read', 'writes', 'bytes_written',
+                'flushes', 'fsyncs', 'commits', 'lock_waits', 'lock_wait_seconds')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """
+        Zero all counters and forget all recorded latencies.
+        """
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.latencies = {}
+        self.depths = {}
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    def record(self, op, seconds):
+        """
+        Add the duration of one call of op to its histogram.
+        """
+        microseconds = math.ceil(seconds * 1e6)
+        bucket = 1 << max(microseconds - 1, 0).bit_length()
+        histogram = self.latencies.setdefault(op, {})
+        histogram[bucket] = histogram.get(bucket, 0) + 1
+
+    def record_depth(self, depth):
+        """
+        Add the number of nodes a lookup visited to the depth histogram.
+        """
+        self.depths[depth] = self.depths.get(depth, 0) + 1
+
+    def info(self):
+        """
+        Return all counters and histograms as a dict.
+        """
+        info = dict(self.counters)
+        info['latency_us'] = {op: dict(sorted(histogram.items()))
+                              for op, histogram in self.latencies.items()}
+        info['depth'] = dict(sorted(self.depths.items()))
+        return info
+
 class Storage(object):
     SUPERBLOCK_SIZE = 4096
     INTEGER_FORMAT = "!Q"
     INTEGER_LENGTH = 8
-
-    def __init__(self, f):
+    # root address, then for group commit: the last fsynced root, the file size
+    # at that fsync, the file size when the root was published, and the crc32 of
+    # the bytes between those two sizes
+    SUPERBLOCK = struct.Struct("!QQQQQ")
+
+    def __init__(self, f, node_cache=None, use_mmap=False, path=None,
+                 durability='flush', group_window=0.05, group_bytes=1 << 22,
+                 buffer_bytes=1 << 20, stats=None, inline_values=64):
+        if durability not in DURABILITY_MODES:
+            raise ValueError("durability must be one of %s" % (DURABILITY_MODES,))
         self._f = f
+        self._path = path
         self.locked = False
+        self.node_cache = node_cache
+        self.stats = stats
+        self.inline_values = inline_values
+        self.use_mmap = use_mmap
+        self._mmap = None
+        # While locked, writes are appended to this buffer instead of the file.
+        # Nobody else can append then, so the end of the file is tracked here
+        # and each record gets its address without a seek.
+        self._buffer = bytearray()
+        self._buffer_address = None # file address of the start of the buffer
+        self._locked_address = None # end of the file when the lock was taken
+        self.buffer_bytes = buffer_bytes
+        self.durability = durability
+        self.group_window = group_window
+        self.group_bytes = group_bytes
+        self._unsynced = False # group commit: roots were published but not fsynced
+        self._group_started = 0.0
+        self._group_address = 0
         #we ensure that we start in a sector boundary
         self._ensure_superblock()
 
@@ -539,22 +1206,58 @@ class Storage(object):
         end_address = self._f.tell()
         if end_address < self.SUPERBLOCK_SIZE:
             self._f.write(b'\x00' * (self.SUPERBLOCK_SIZE - end_address))
+        else:
+            self._recover()
         self.unlock()
 
+    def _recover(self):
+        """
+        Fall back to the last fsynced root if group commit published a later root
+        whose records did not all reach the disk (e.g. the OS crashed before the
+        fsync). The crc32 of the bytes appended since the fsync tells.
+        """
+        root_address, durable_address, durable_end, published_end, crc = self._read_superblock()
+        if durable_end == 0 or root_address == durable_address:
+            return
+        self._seek_end()
+        if self._f.tell() < published_end or self._checksum(durable_end, published_end) != crc:
+            self._write_superblock(durable_address, durable_address, durable_end, durable_end, 0)
+            self._f.flush()
+            self._fsync()
+
     def lock(self):
         "if not locked, lock the file for writing"
         if not self.locked:
-            portalocker.lock(self._f, portalocker.LOCK_EX)
+            if self.stats is None:
+                portalocker.lock(self._f, portalocker.LOCK_EX)
+            else:
+                try:
+                    portalocker.lock(self._f, portalocker.LOCK_EX | portalocker.LOCK_NB)
+                except portalocker.LockException:
+                    # another connection holds the lock: count the wait for it
+                    start = time.perf_counter()
+                    portalocker.lock(self._f, portalocker.LOCK_EX)
+                    self.stats.count('lock_waits')
+                    self.stats.count('lock_wait_seconds', time.perf_counter() - start)
             self.locked = True
+            if self.replaced:
+                # anything written now would go to the old, unlinked file
+                self.unlock()
+                raise IOError("%s was replaced (e.g. compacted); reconnect to write to it" % self._path)
+            self._seek_end()
+            self._buffer_address = self._locked_address = self._f.tell()
             return True
         else:
             return False
 
     def unlock(self):
         if self.locked:
+            self.flush_buffer()
             self._f.flush()
             portalocker.unlock(self._f)
             self.locked = False
+            # other writers may append now
+            self._buffer_address = self._locked_address = None
 
     def _seek_end(self):
         self._f.seek(0, os.SEEK_END)
@@ -572,6 +1275,29 @@ class Storage(object):
     def _read_integer(self):
         return self._bytes_to_integer(self._f.read(self.INTEGER_LENGTH))
 
+    def _read_superblock(self):
+        # seeking to the end first drops the read buffer (see get_root_address)
+        self._seek_end()
+        self._seek_superblock()
+        return self.SUPERBLOCK.unpack(self._f.read(self.SUPERBLOCK.size))
+
+    def _write_superblock(self, *fields):
+        self.lock()
+        self._seek_superblock()
+        #write is atomic because all fields lie in the first sector
+        self._f.write(self.SUPERBLOCK.pack(*fields))
+
+    def _checksum(self, start, end, crc=0):
+        "crc32 of the file bytes from start up to end, continuing from crc"
+        self._f.seek(start)
+        while start < end:
+            chunk = self._f.read(min(end - start, 1 << 20))
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            start += len(chunk)
+        return crc
+
     def _write_integer(self, integer):
         self.lock()
         self._f.write(self._integer_to_bytes(integer))
@@ -582,49 +1308,282 @@ class Storage(object):
         #write data, unlock <==WRONG, dont want to unlock here
         #your code here
         self.lock()
-        self._seek_end()
-        object_address = self._f.tell()
-        self._write_integer(len(data))
-        self._f.write(data)
+        object_address = self._buffer_address + len(self._buffer)
+        self._buffer += self._integer_to_bytes(len(data))
+        self._buffer += data
+        if self.stats is not None:
+            self.stats.count('writes')
+            self.stats.count('bytes_written', len(data))
+        if len(self._buffer) >= self.buffer_bytes:
+            self.flush_buffer()
         return object_address
 
+    def flush_buffer(self):
+        "append all buffered writes to the file in one write"
+        if self._buffer:
+            if self.stats is not None:
+                self.stats.count('flushes')
+            self._f.seek(self._buffer_address)
+            self._f.write(self._buffer)
+            self._buffer_address += len(self._buffer)
+            self._buffer = bytearray()
+
+    def discard_buffer(self):
+        "forget buffered writes that have not reached the file yet"
+        self._buffer = bytearray()
+        if self.node_cache is not None and self._buffer_address is not None:
+            # their addresses will be reused by the next writes
+            self.node_cache.discard_from(self._buffer_address)
+
+    def _buffered(self, address):
+        "check if a record is still in the append buffer"
+        return self._buffer_address is not None and address >= self._buffer_address
+
+    def _read_buffer(self, address):
+        "read a record that is still in the append buffer"
+        offset = address - self._buffer_address
+        start = offset + self.INTEGER_LENGTH
+        length = struct.unpack_from(self.INTEGER_FORMAT, self._buffer, offset)[0]
+        return bytes(self._buffer[start:start + length])
+
+    def _remap(self):
+        "map the whole file for reading; pending writes are flushed first so they are visible"
+        self._f.flush()
+        if self._mmap is not None:
+            self._mmap.close()
+        self._mmap = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _mapped(self, end):
+        "get a map of the file that covers addresses up to end, remapping if the file grew"
+        if self._mmap is None or len(self._mmap) < end:
+            self._remap()
+        return self._mmap
+
     def read(self, address):
-        self._f.seek(address)
-        length = self._read_integer()
-        data = self._f.read(length)
+        if self._buffered(address):
+            data = self._read_buffer(address)
+        elif self.use_mmap:
+            start = address + self.INTEGER_LENGTH
+            length = struct.unpack_from(self.INTEGER_FORMAT, self._mapped(start), address)[0]
+            data = self._mapped(start + length)[start:start + length]
+        else:
+            self._f.seek(address)
+            length = self._read_integer()
+            data = self._f.read(length)
+        if self.stats is not None:
+            self.stats.count('reads')
+            self.stats.count('bytes_read', len(data))
         return data
 
-    def commit_root_address(self, root_address):
-        self.lock()
+    def _write_root(self, root_address, fsync=False):
+        "write the root address once everything it points to is on disk (or at least in the OS)"
         self._f.flush()
-        #make sure you write root address at position 0
-        self._seek_superblock()
-        #write is atomic because we store the address on a sector boundary.
-        self._write_integer(root_address)
+        if fsync:
+            self._fsync()
+            # the root is durable now, so it is what recovery falls back to
+            self._seek_end()
+            end = self._f.tell()
+            self._write_superblock(root_address, root_address, end, end, 0)
+        else:
+            #make sure you write root address at position 0
+            self._seek_superblock()
+            #write is atomic because we store the address on a sector boundary.
+            self._write_integer(root_address)
         self._f.flush()
+        if fsync:
+            self._fsync()
+
+    def _publish_root(self, root_address):
+        """
+        Write the root address without an fsync, along with the crc32 of all bytes
+        appended since the last fsync, for _recover() to check them with.
+        Returns False, writing nothing, if there was no fsync to fall back to yet.
+        """
+        self._f.flush()
+        _, durable_address, durable_end, published_end, crc = self._read_superblock()
+        if durable_end == 0:
+            return False
+        self._seek_end()
+        end = self._f.tell()
+        crc = self._checksum(published_end, end, crc)
+        self._write_superblock(root_address, durable_address, durable_end, end, crc)
+        self._f.flush()
+        return True
+
+    def _fsync(self):
+        if self.stats is not None:
+            self.stats.count('fsyncs')
+        os.fsync(self._f.fileno())
+
+    def commit_root_address(self, root_address):
+        self.lock()
+        if self.stats is not None:
+            self.stats.count('commits')
+        self.flush_buffer()
+        if self.durability == 'group':
+            if not self._unsynced:
+                # first commit of a new group
+                self._group_started = time.time()
+                self._group_address = self._locked_address
+            # without an fsync to fall back to yet, the group starts with one
+            if (time.time() - self._group_started >= self.group_window or
+                    self._buffer_address - self._group_address >= self.group_bytes or
+                    not self._publish_root(root_address)):
+                # one fsync pair makes this commit and all before it durable
+                self._write_root(root_address, fsync=True)
+                self._unsynced = False
+            else:
+                self._unsynced = True
+            self.unlock()
+            return
+        if self.durability == 'none':
+            self._seek_superblock()
+            self._write_integer(root_address)
+        else:
+            self._write_root(root_address, fsync=self.durability == 'fsync')
         self.unlock()
 
+    def sync(self):
+        """
+        Fsync the commits that group commit has published but not made durable yet.
+        """
+        if self._unsynced:
+            locked = self.lock()
+            # the last root published, by any connection, is durable after this
+            self._write_root(self._read_superblock()[0], fsync=True)
+            if locked:
+                self.unlock()
+            self._unsynced = False
+
     def get_root_address(self):
         #read the first integer in the file
         #your code here
+        if self.use_mmap:
+            # the map is shared, so it sees commits made through other file handles
+            return struct.unpack_from(self.INTEGER_FORMAT, self._mapped(self.INTEGER_LENGTH), 0)[0]
+        # a seek back into the read buffer would be served from memory, and
+        # would miss roots committed by other connections; seeking to the end
+        # first drops the buffer
+        self._seek_end()
         self._seek_superblock()
         root_address = self._read_integer()
         return root_address
 
     def close(self):
         self.unlock()
+        self.sync()
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
         self._f.close()
 
     @property
     def closed(self):
         return self._f.closed
 
+    @property
+    def size(self):
+        "size of the file in bytes"
+        return os.fstat(self._f.fileno()).st_size
+
+    @property
+    def replaced(self):
+        "check if the path we were opened with now points to a different file"
+        if self._path is None:
+            return False
+        try:
+            path_stat = os.stat(self._path)
+        except OSError:
+            return True
+        file_stat = os.fstat(self._f.fileno())
+        return (path_stat.st_dev, path_stat.st_ino) != (file_stat.st_dev, file_stat.st_ino)
+
+class Snapshot(object):
+    """
+    A read-only view of the database as of one commit.
+
+    Parameters
+    ----------
+    storage : Storage
+    root_address : int
+        Address of the committed root to read.
+
+    Notes
+    -----
+    PRE: The file is append-only, so a committed tree is never changed.
+         Reads through a snapshot never lock and are not affected by later commits.
+    WARNINGS: Shares the storage of the DBDB it came from; it is unusable once that is closed.
+    """
+    def __init__(self, storage, root_address):
+        self._storage = storage
+        self._tree = RedBlackTree(storage, root_address)
+        self.root_address = root_address
+
+    def _assert_not_closed(self):
+        if self._storage.closed:
+            raise ValueError('Database closed.')
+
+    def get(self, key):
+        self._assert_not_closed()
+        return self._tree.get(key)
+
+    def get_many(self, keys):
+        self._assert_not_closed()
+        return self._tree.get_many(keys)
+
+    def get_min(self):
+        self._assert_not_closed()
+        return self._tree.get_min()
+
+    def chop(self, chop_key):
+        self._assert_not_closed()
+        return self._tree.chop(chop_key)
+
+    def range(self, lo=None, hi=None, reverse=False):
+        self._assert_not_closed()
+        return self._tree.range(lo, hi, reverse)
+
+    def count_range(self, lo=None, hi=None):
+        self._assert_not_closed()
+        return self._tree.count_range(lo, hi)
+
+    def nearest_keys(self, key, k):
+        self._assert_not_closed()
+        return self._tree.nearest_keys(key, k)
+
+    def iter_nearest(self, key):
+        self._assert_not_closed()
+        return self._tree.iter_nearest(key)
+
+
+def _timed(method):
+    """
+    Record how long each call of a DBDB method takes, if the connection keeps stats.
+    """
+    op = method.__name__
+    @wraps(method)
+    def timed(self, *args, **kwargs):
+        stats = self._storage.stats
+        if stats is None:
+            return method(self, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            stats.record(op, time.perf_counter() - start)
+    return timed
+
 class DBDB(object):
 
     # documentation for parallel methods in RedBlackTree() class.
-    def __init__(self, f):
-        self._storage = Storage(f)
+    def __init__(self, f, node_cache=None, use_mmap=False, path=None,
+                 durability='flush', group_window=0.05, group_bytes=1 << 22,
+                 stats=None, inline_values=64):
+        self._storage = Storage(f, node_cache, use_mmap, path,
+                                durability, group_window, group_bytes,
+                                stats=stats, inline_values=inline_values)
         self._tree = RedBlackTree(self._storage)
+        self._batching = False
 
     def _assert_not_closed(self):
         if self._storage.closed:
@@ -633,18 +1592,78 @@ class DBDB(object):
     def close(self):
         self._storage.close()
 
+    @_timed
     def commit(self):
         self._assert_not_closed()
+        if self._batching:
+            # deferred until the batch ends
+            return
         self._tree.commit()
 
+    @contextmanager
+    def batch(self):
+        """
+        Group many set() calls into a single transaction.
+        e.g.
+            with db.batch():
+                for key, value in items:
+                    db.set(key, value)
+
+        The root is committed once when the block ends, with all new nodes
+        appended to the file in one write. commit() calls inside the block are
+        deferred to its end. If the block raises, its changes are discarded.
+        """
+        self._assert_not_closed()
+        if self._batching:
+            yield self
+            return
+        self._batching = True
+        try:
+            yield self
+        except BaseException:
+            self._batching = False
+            self._tree.rollback()
+            raise
+        self._batching = False
+        self._tree.commit()
+
+    def sync(self):
+        """
+        Make all commits durable now, instead of waiting for the group
+        commit window to pass.
+        """
+        self._assert_not_closed()
+        self._storage.sync()
+
+    def snapshot(self):
+        """
+        Return a read-only Snapshot of the last committed tree. It keeps
+        returning the same results however many commits come after it.
+        """
+        self._assert_not_closed()
+        return Snapshot(self._storage, self._storage.get_root_address())
+
+    @_timed
     def get(self, key):
         self._assert_not_closed()
         return self._tree.get(key)
 
+    @_timed
+    def get_many(self, keys):
+        self._assert_not_closed()
+        return self._tree.get_many(keys)
+
+    @_timed
     def set(self, key, value):
         self._assert_not_closed()
         return self._tree.set(key, value)
+
+    @_timed
+    def bulk_load(self, sorted_items):
+        self._assert_not_closed()
+        return self._tree.bulk_load(sorted_items)
     
+    @_timed
     def get_min(self):
         self._assert_not_closed()
         return self._tree.get_min()
@@ -657,10 +1676,75 @@ class DBDB(object):
         self._assert_not_closed()
         return self._tree.get_right(key)
 
+    @_timed
     def chop(self, chop_key):
         self._assert_not_closed()
         return self._tree.chop(chop_key)
 
+    def range(self, lo=None, hi=None, reverse=False):
+        self._assert_not_closed()
+        return self._tree.range(lo, hi, reverse)
+
+    @_timed
+    def count_range(self, lo=None, hi=None):
+        self._assert_not_closed()
+        return self._tree.count_range(lo, hi)
+
+    @_timed
+    def nearest_keys(self, key, k):
+        self._assert_not_closed()
+        return self._tree.nearest_keys(key, k)
+
+    def iter_nearest(self, key):
+        self._assert_not_closed()
+        return self._tree.iter_nearest(key)
+
+    def space_report(self):
+        """
+        Returns a dict with the file size, the bytes used by the committed tree,
+        the bytes left behind by earlier versions of the tree and the live ratio.
+        """
+        self._assert_not_closed()
+        file_bytes = self._storage.size
+        live_bytes = min(self._tree.live_bytes(), file_bytes)
+        return {
+            'file_bytes': file_bytes,
+            'live_bytes': live_bytes,
+            'dead_bytes': file_bytes - live_bytes,
+            'live_ratio': live_bytes / file_bytes if file_bytes else 1.0,
+        }
+
+    def cache_info(self):
+        """
+        Returns hit/miss counters and size of the node cache, or None if caching is off.
+        """
+        if self._storage.node_cache is None:
+            return None
+        return self._storage.node_cache.info()
+
+    def stats(self):
+        """
+        Returns I/O counters, per operation latency histograms and the
+        lookup depth histogram as a dict, or None if stats are off.
+        Node cache hits and misses are included when caching is on.
+        """
+        if self._storage.stats is None:
+            return None
+        info = self._storage.stats.info()
+        if self._storage.node_cache is not None:
+            info['cache_hits'] = self._storage.node_cache.hits
+            info['cache_misses'] = self._storage.node_cache.misses
+        return info
+
+    def reset_stats(self):
+        """
+        Zero the stats and the node cache counters, e.g. before measuring one operation.
+        """
+        if self._storage.stats is not None:
+            self._storage.stats.reset()
+        if self._storage.node_cache is not None:
+            self._storage.node_cache.hits = self._storage.node_cache.misses = 0
+
     # METHODS FOR PLOTTING RED BLACK TREE
     def root_key(self):
         """
@@ -697,10 +1781,119 @@ class DBDB(object):
             print(str(key)+' left: '+str(self.first_generation_children(key)))
             print(str(key)+' right: '+str(self.first_generation_children(key))+"\n")           
 
-def connect(dbname):
+def connect(dbname, cache_size=None, cache_bytes=None, use_mmap=False,
+            durability='flush', group_window=0.05, group_bytes=1 << 22, stats=False,
+            inline_values=64):
+    """
+    Open (or create) a database file.
+
+    Parameters
+    ----------
+    dbname : string
+        Path of the database file.
+    cache_size : int
+        Keep up to this many decoded nodes in an LRU cache. Optional.
+    cache_bytes : int
+        Keep up to this many bytes of node records in an LRU cache. Optional.
+        Caching is off unless at least one of the limits is given.
+    use_mmap : bool
+        Read nodes and values through a memory map of the file instead of
+        seek and read calls. Defaults to False.
+    durability : string
+        One of 'none', 'flush', 'fsync' or 'group'; see DURABILITY_MODES.
+        Defaults to 'flush'.
+    group_window : float
+        With 'group', fsync at the first commit made at least this many
+        seconds after the oldest commit that was not fsynced.
+    group_bytes : int
+        With 'group', also fsync once this many bytes were appended.
+    stats : bool
+        Keep I/O counters and latency histograms; see DBDB.stats(). Defaults to False.
+    inline_values : int
+        Values of up to this many bytes are written into their node record
+        instead of a record of their own, saving a read per value. 0 turns
+        this off. Defaults to 64.
+
+    Notes
+    -----
+    WARNINGS: With 'group' every commit is visible to other connections at
+              once and the lock is released after it, but it is only durable
+              once the window passes, sync() or close() is called. After an
+              OS crash before that, the database comes back at the last root
+              whose records all reached the disk: the last fsynced one, or a
+              later one whose bytes pass the crc32 check on connect.
+    """
     try:
         f = open(dbname, 'r+b')
     except IOError:
         fd = os.open(dbname, os.O_RDWR | os.O_CREAT)
         f = os.fdopen(fd, 'r+b')
-    return DBDB(f)
+    node_cache = None
+    if cache_size is not None or cache_bytes is not None:
+        node_cache = NodeCache(cache_size, cache_bytes)
+    # an absolute path, so a later os.chdir() does not look like a replaced file
+    return DBDB(f, node_cache, use_mmap, os.path.abspath(dbname), durability, group_window, group_bytes,
+                Stats() if stats else None, inline_values)
+
+def space_report(dbname):
+    """
+    Report how much of a database file is used by the committed tree.
+
+    Returns
+    -------
+    dict with file_bytes, live_bytes, dead_bytes and live_ratio (live_bytes / file_bytes)
+    """
+    db = connect(dbname)
+    try:
+        return db.space_report()
+    finally:
+        db.close()
+
+def compact(dbname, min_live_ratio=None):
+    """
+    Rewrite a database file so it only holds the committed tree.
+
+    Every node and value that is no longer reachable from the committed root
+    (left behind by path copying on set) is dropped. The live key-value pairs
+    are bulk loaded into a fresh file next to the old one, which then
+    atomically replaces it.
+
+    Parameters
+    ----------
+    dbname : string
+        Path of the database file.
+    min_live_ratio : float
+        Only compact if the live_ratio from space_report() is below this. Optional.
+
+    Returns
+    -------
+    True if the file was compacted, False if it was skipped.
+
+    Notes
+    -----
+    PRE: The old file stays locked while it is copied, so writers wait for the
+         compaction to finish. Readers never lock and keep reading the old file.
+    WARNINGS: Connections opened before the swap keep seeing the old file.
+              Writing through them raises IOError; reconnect instead.
+    """
+    db = connect(dbname)
+    try:
+        # hold the write lock so no commits land in the old file while we copy it
+        db._storage.lock()
+        db._tree._refresh_tree_ref()
+        if min_live_ratio is not None and db.space_report()['live_ratio'] >= min_live_ratio:
+            return False
+        compact_name = dbname + '.compact'
+        if os.path.exists(compact_name):
+            os.remove(compact_name)
+        new_db = connect(compact_name)
+        try:
+            with new_db.batch():
+                new_db.bulk_load(db._tree.range())
+            os.fsync(new_db._storage._f.fileno())
+        finally:
+            new_db.close()
+        os.replace(compact_name, dbname)
+        return True
+    finally:
+        db.close()
@@ -0,0 +1,351 @@
+#!/usr/local/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+corpus.py
+
+Keeps all stored light curves in memory, standardized, so similarity searches
+can score candidates without going back to disk.
+
+Main functions:
+    - get_corpus            Returns the resident corpus of a light curve dir, loading it on first use
+    - add_to_corpus         Adds newly stored time series to the resident corpus of a dir (if loaded)
+
+"""
+
+import heapq
+import uuid
+import numpy as np
+from cs207project.tsrbtreedb.crosscorr import kernel_dist_many, kernel_dist_spectra, kernel_norms, spectrum, standardize_rows
+from cs207project.storagemanager.filestoragemanager import FileStorageManager
+
+# Resident corpora, by light curve dir
+_corpora = {}
+
+# Rounding allowance when comparing a lower bound to an exact distance
+BOUND_SLACK = 1e-9
+
+def get_corpus(lc_dir, generation=None):
+    """
+    Returns the resident Corpus of lc_dir. It is loaded from disk on the first
+    call only; later calls return the same object.
+
+    Worker processes pass the generation of the parent's corpus. A resident
+    corpus of another generation may hold light curves that were regenerated
+    since (under the same ids), so it is loaded again, and takes that generation.
+    """
+    corpus = _corpora.get(lc_dir)
+    if corpus is None or (generation is not None and corpus.generation != generation):
+        corpus = _corpora[lc_dir] = Corpus(lc_dir)
+        if generation is not None:
+            corpus.generation = generation
+    return corpus
+
+def add_to_corpus(lc_dir, ts_ids, ts_list):
+    """
+    Adds time series that were just stored in lc_dir to its resident corpus.
+    Does nothing if the corpus of lc_dir has not been loaded.
+    """
+    corpus = _corpora.get(lc_dir)
+    if corpus is not None:
+        corpus.add_many(ts_ids, ts_list)
+
+def clear_corpora():
+    """Forgets all resident corpora (e.g. after the light curve files were regenerated)"""
+    _corpora.clear()
+
+
+class Corpus(object):
+    """
+    All light curves of a light curve dir, standardized, as the rows of one matrix.
+
+    Attributes:
+        ids: light curve ids (e.g. 'ts_datafile_12'), in row order
+        values: (n, TS_LENGTH) float64 matrix of standardized values
+        spectra: (n, TS_LENGTH//2 + 1) matrix of the real-input FFTs of the rows of values
+        self_norms: (n,) kernel of each row with itself, sum(exp(mult * ccor(x, x)))
+        evaluations: number of exact distances calculated so far
+        generation: unique id of this load of the light curve dir (see get_corpus)
+
+    Notes:
+        - Rows live in arrays with spare capacity, so adding a series does not
+          copy the whole matrix.
+        - Stored light curves never change, so a row stays valid once loaded.
+          Series stored by other processes are picked up by refresh().
+    """
+
+    def __init__(self, lc_dir, mult=1):
+        self.lc_dir = lc_dir
+        self.mult = mult
+        self.ids = []
+        self._rows = {}
+        self._values = None
+        self._spectra = None
+        self._self_norms = None
+        self._vp_fns = None
+        self._vp_table = None
+        self.evaluations = 0
+        self.generation = uuid.uuid4().hex
+        self.refresh()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, ts_id):
+        return ts_id in self._rows
+
+    @property
+    def values(self):
+        return self._values[:len(self.ids)]
+
+    @property
+    def spectra(self):
+        return self._spectra[:len(self.ids)]
+
+    @property
+    def self_norms(self):
+        return self._self_norms[:len(self.ids)]
+
+    def refresh(self):
+        """Loads light curves that were stored in lc_dir since the corpus was loaded"""
+        fsm = FileStorageManager(self.lc_dir)
+        new_ids = [ts_id for ts_id in fsm.get_ids() if ts_id not in self._rows]
+        self.add_many(new_ids, [fsm.get(ts_id) for ts_id in new_ids])
+
+    def add(self, ts_id, ts):
+        """Adds a single time series, unless a series with its id is already in the corpus"""
+        self.add_many([ts_id], [ts])
+
+    def add_many(self, ts_ids, ts_list):
+        """Adds time series, skipping ids already in the corpus"""
+        new = [(ts_id, ts) for ts_id, ts in zip(ts_ids, ts_list) if ts_id not in self._rows]
+        if not new:
+            return
+        values = standardize_rows([ts.values() for _, ts in new])
+        spectra = spectrum(values)
+        self_norms = kernel_norms(spectra, values.shape[1], self.mult)
+
+        start = len(self.ids)
+        self._reserve(start + len(new), values.shape[1])
+        self._values[start:start + len(new)] = values
+        self._spectra[start:start + len(new)] = spectra
+        self._self_norms[start:start + len(new)] = self_norms
+        for i, (ts_id, _) in enumerate(new):
+            self._rows[ts_id] = start + i
+            self.ids.append(ts_id)
+
+    def _reserve(self, n, length):
+        """Makes room for n rows, doubling the capacity when it runs out"""
+        if self._values is not None and n <= len(self._values):
+            return
+        capacity = max(n, 2 * len(self.ids), 64)
+        values = np.empty((capacity, length), dtype=np.float64)
+        spectra = np.empty((capacity, length // 2 + 1), dtype=np.complex128)
+        self_norms = np.empty(capacity, dtype=np.float64)
+        if self._values is not None:
+            n_old = len(self.ids)
+            values[:n_old] = self._values[:n_old]
+            spectra[:n_old] = self._spectra[:n_old]
+            self_norms[:n_old] = self._self_norms[:n_old]
+        self._values, self._spectra, self._self_norms = values, spectra, self_norms
+
+    def rows(self, ts_ids):
+        """
+        Returns the row numbers of ts_ids as an array, refreshing the corpus once
+        if some of them are not loaded yet.
+
+        Raises:
+            ValueError: if a time series is not in the light curve dir
+        """
+        if any(ts_id not in self._rows for ts_id in ts_ids):
+            self.refresh()
+        try:
+            return np.array([self._rows[ts_id] for ts_id in ts_ids], dtype=np.intp)
+        except KeyError as e:
+            raise ValueError("time series '%s' does not appear to be in the database" % e.args[0])
+
+    def kernel_dists(self, s_ts, ts_ids=None):
+        """
+        Calculates the kernel distance from a standardized time series to light
+        curves in the corpus, all at once.
+
+        Args:
+            s_ts: standardized time series to measure from
+            ts_ids: ids of the light curves to measure to. Defaults to all of them.
+        Returns:
+            np.array of distances, in the order of ts_ids
+        Note:
+            Gives the same distances as crosscorr.kernel_dist(standardize(candidate), s_ts)
+        """
+        if ts_ids is None:
+            values, spectra, self_norms = self.values, self.spectra, self.self_norms
+        else:
+            rows = self.rows(ts_ids)
+            values, spectra, self_norms = self._values[rows], self._spectra[rows], self._self_norms[rows]
+        self.evaluations += len(values)
+        return kernel_dist_many(s_ts, values, self.mult, spectra=spectra, self_norms=self_norms)
+
+    def vp_table(self, vp_fns):
+        """
+        Returns the (n, k) table of distances from every light curve in the corpus
+        (by row) to each of the k vantage points vp_fns (by column).
+
+        The table is calculated on first use and kept up to date as series are
+        added. Asking for a different set of vantage points recalculates it.
+        """
+        vp_fns = tuple(vp_fns)
+        if self._vp_fns != vp_fns:
+            self._vp_fns, self._vp_table = vp_fns, np.empty((0, len(vp_fns)))
+        n_done = len(self._vp_table)
+        if n_done < len(self.ids):
+            vp_values = self._values[self.rows(vp_fns)]
+            new = np.empty((len(self.ids) - n_done, len(vp_fns)))
+            for i, vp in enumerate(vp_values):
+                new[:, i] = kernel_dist_many(vp, self.values[n_done:], self.mult,
+                    spectra=self.spectra[n_done:], self_norms=self.self_norms[n_done:])
+            self._vp_table = np.concatenate([self._vp_table, new])
+        return self._vp_table
+
+    def lower_bounds(self, q_to_vps, ts_ids, vp_fns):
+        """
+        Returns the triangle inequality lower bounds max_i |d(q, vp_i) - d(x, vp_i)|
+        on the distance from a query q to each light curve x in ts_ids, given the
+        distances q_to_vps from the query to the vantage points vp_fns.
+        """
+        # rows() may load new light curves, so it goes before the table is extended
+        rows = self.rows(ts_ids)
+        table = self.vp_table(vp_fns)
+        return np.max(np.abs(table[rows] - q_to_vps), axis=1)
+
+    def nearest(self, s_ts, ts_ids, k, vp_fns=(), block=32):
+        """
+        Finds the k light curves among ts_ids closest to a standardized time series.
+
+        With vantage points, candidates are visited in order of their triangle
+        inequality lower bound max_i |d(q, vp_i) - d(x, vp_i)|, in doubling blocks,
+        and the search stops once the next bound is beyond the current k-th best
+        distance. The result is the same as scoring every candidate.
+
+        Args:
+            s_ts: standardized time series to measure from
+            ts_ids: ids of the candidate light curves
+            k: number of closest light curves to return
+            vp_fns: ids of vantage points to prune with (see vp_table)
+            block: number of candidates to score in the first block after the k best bounds
+        Returns:
+            List of (distance, ts_id) tuples for the k closest, closest first
+        """
+        ts_ids = list(ts_ids)
+        if not vp_fns or len(ts_ids) <= k:
+            return heapq.nsmallest(k, zip(self.kernel_dists(s_ts, ts_ids), ts_ids))
+
+        q_to_vps = self.kernel_dists(s_ts, list(vp_fns))
+        bounds = self.lower_bounds(q_to_vps, ts_ids, vp_fns)
+        order = np.argsort(bounds, kind='stable')
+
+        # score in growing blocks, so a search that prunes well stops early and
+        # one that does not still scores in a few large batches. Candidates past
+        # the last bound within the k-th best distance so far are never scored.
+        sorted_bounds = bounds[order]
+        dists = np.empty(len(order))
+        start, end, size = 0, len(order), max(k, block)
+        while start < end:
+            ids = [ts_ids[i] for i in order[start:min(start + size, end)]]
+            dists[start:start + len(ids)] = self.kernel_dists(s_ts, ids)
+            start += len(ids)
+            size *= 2
+            if start >= k:
+                kth_best = np.partition(dists[:start], k - 1)[k - 1]
+                end = max(start, np.searchsorted(sorted_bounds, kth_best + BOUND_SLACK, side='right'))
+        return heapq.nsmallest(k, zip(dists[:start], [ts_ids[i] for i in order[:start]]))
+
+    def kernel_dist_matrix(self, q_values, ts_ids, max_pairs=1 << 16):
+        """
+        Calculates the kernel distance from each of many standardized queries
+        (the rows of q_values) to each of the light curves ts_ids.
+
+        Returns:
+            (len(q_values), len(ts_ids)) np.array of distances
+        """
+        q_values = np.atleast_2d(np.asarray(q_values, dtype=np.float64))
+        if np.any(np.abs(q_values.mean(axis=1)) >= .0001):
+            raise ValueError("time series must be standardized before calculating kernel distance")
+        rows = self.rows(ts_ids)
+        q_spectra = spectrum(q_values)
+        q_norms = kernel_norms(q_spectra, q_values.shape[1], self.mult)
+        q_idx = np.repeat(np.arange(len(q_values)), len(rows))
+        dists = self._pair_dists(q_spectra, q_norms, q_idx, np.tile(rows, len(q_values)), max_pairs)
+        return dists.reshape(len(q_values), len(rows))
+
+    def _pair_dists(self, q_spectra, q_norms, q_idx, rows, max_pairs):
+        """
+        Kernel distances between query q_idx[i] and corpus row rows[i], for each i,
+        scored max_pairs at a time.
+        """
+        length = self._values.shape[1]
+        dists = np.empty(len(rows))
+        for i in range(0, len(rows), max_pairs):
+            q, r = q_idx[i:i + max_pairs], rows[i:i + max_pairs]
+            dists[i:i + len(r)] = kernel_dist_spectra(q_spectra[q], self._spectra[r],
+                                                      q_norms[q], self._self_norms[r], length, self.mult)
+        self.evaluations += len(rows)
+        return dists
+
+    def nearest_many(self, q_values, ts_ids, k, vp_fns=(), max_pairs=1 << 16):
+        """
+        Finds the k light curves among ts_ids closest to each of many queries at once.
+
+        With vantage points, each query first scores the k candidates with the lowest
+        lower bounds (see lower_bounds). The k-th best of those caps its k-th best
+        distance, and only candidates with a bound within that cap are scored after
+        that. All scoring is done in batches of (query, candidate) pairs.
+
+        Args:
+            q_values: 2d array with the values of one standardized query per row
+            ts_ids: ids of the candidate light curves, shared by all the queries
+            k: number of closest light curves to return per query
+            vp_fns: ids of vantage points to prune with (see vp_table)
+            max_pairs: most (query, candidate) pairs to hold in memory at a time
+        Returns:
+            List with a list of (distance, ts_id) tuples per query, closest first,
+            the same as nearest() gives for each query
+        """
+        q_values = np.atleast_2d(np.asarray(q_values, dtype=np.float64))
+        if np.any(np.abs(q_values.mean(axis=1)) >= .0001):
+            raise ValueError("time series must be standardized before calculating kernel distance")
+        ts_ids = list(ts_ids)
+        rows = self.rows(ts_ids)
+        q_spectra = spectrum(q_values)
+        q_norms = kernel_norms(q_spectra, q_values.shape[1], self.mult)
+        if vp_fns:
+            vp_rows = self.rows(list(vp_fns))
+            table = self.vp_table(vp_fns)[rows]
+
+        results = []
+        chunk = max(1, max_pairs // max(len(rows), 1))
+        for start in range(0, len(q_values), chunk):
+            queries = np.arange(start, min(start + chunk, len(q_values)))
+            if vp_fns and len(rows) > k:
+                # lower bounds for every (query, candidate) pair, one vantage point at a time
+                q_to_vps = self._pair_dists(q_spectra, q_norms, np.repeat(queries, len(vp_rows)),
+                                            np.tile(vp_rows, len(queries)), max_pairs).reshape(len(queries), -1)
+                bounds = np.zeros((len(queries), len(rows)))
+                for i in range(len(vp_rows)):
+                    np.maximum(bounds, np.abs(q_to_vps[:, i, None] - table[None, :, i]), out=bounds)
+
+                # 1. cap each k-th best distance with the k candidates of lowest bound
+                first = np.argpartition(bounds, k - 1, axis=1)[:, :k]
+                caps = self._pair_dists(q_spectra, q_norms, np.repeat(queries, k), rows[first.ravel()],
+                                        max_pairs).reshape(len(queries), k).max(axis=1)
+
+                # 2. score every candidate that could be within the cap
+                q_pos, c_pos = np.nonzero(bounds <= caps[:, None] + BOUND_SLACK)
+            else:
+                q_pos = np.repeat(np.arange(len(queries)), len(rows))
+                c_pos = np.tile(np.arange(len(rows)), len(queries))
+
+            dists = self._pair_dists(q_spectra, q_norms, queries[q_pos], rows[c_pos], max_pairs)
+            splits = np.searchsorted(q_pos, np.arange(len(queries) + 1))
+            for lo, hi in zip(splits[:-1], splits[1:]):
+                results.append(heapq.nsmallest(k, zip(dists[lo:hi], [ts_ids[c] for c in c_pos[lo:hi]])))
+        return results
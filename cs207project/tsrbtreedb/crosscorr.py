@@ -17,13 +17,49 @@ def standardize(ts):
     stand_vals = (ts.values() - ts.mean())/ts.std()
     return ats.ArrayTimeSeries(times=ts.times(), values=stand_vals)
 
+def standardize_rows(matrix):
+    """standardize each row of a 2d array of values, the same way standardize does a time series"""
+    matrix = np.atleast_2d(np.asarray(matrix, dtype=np.float64))
+    return (matrix - matrix.mean(axis=1, keepdims=True)) / matrix.std(axis=1, ddof=1, keepdims=True)
+
+def _values(ts):
+    """values of a time series object, or a raw array of values, as a float64 ndarray"""
+    if not isinstance(ts, np.ndarray):
+        ts = ts.values()
+    return np.asarray(ts, dtype=np.float64)
+
+def spectrum(ts):
+    """
+    Real-input FFT of a time series, for use with ccor_spectra and kernel_norms.
+
+    Args:
+        ts: time series object, or ndarray of values. A 2d array is transformed row by row.
+    Returns:
+        np.array - the len(ts)//2 + 1 non-negative frequency terms (per row)
+    """
+    return nfft.rfft(_values(ts), axis=-1)
+
+def ccor_spectra(X, Y, length):
+    """
+    Cross-correlation of two series given by their spectra (see spectrum).
+
+    Args:
+        X: spectrum of the first series (or one spectrum per row)
+        Y: spectrum of the second series (or one spectrum per row)
+        length: length of the series the spectra came from
+    Returns:
+        np.array - cross-correlation at each shift (per row)
+    """
+    # Normalizing scaler is required so that each shift is counted exactly once
+    return nfft.irfft(X * np.conjugate(Y), n=length, axis=-1) / length
+
 def ccor(ts1, ts2):
     """
     given two standardized time series, compute their cross-correlation using FFT
 
     Args:
-       ts1: first time series object
-       ts2: second time series object
+       ts1: first time series object (or ndarray of values)
+       ts2: second time series object (or ndarray of values)
     Returns:
        Float - cross correlation value.
 
@@ -36,18 +72,10 @@ def ccor(ts1, ts2):
     if len(ts1) != len(ts2):
         raise ValueError("ts1 must be the same length as ts2 to calculate cross correlation")
 
-    # fast fourier transform for ts1
-    X = nfft.fft(ts1.values())
-
-    # Complex conjugate of the fft transform of ts2
-    Yhat = np.conjugate(nfft.fft(ts2.values()))
-
-    # Normalizing scaler is required so that each shift is counted exactly once
-    s = 1 / (1. * len(ts1))
-
-    # The cross-correlation is the convolution of the fft transformed ts1 (X)
-    # and the conjugate of ts2 (Yhat) scaled by s
-    return  nfft.ifft(X * Yhat).real * s
+    # The cross-correlation is the convolution of the fft transformed ts1
+    # and the conjugate of the fft transformed ts2. The series are real, so
+    # the real-input transforms carry all the information in half the terms.
+    return ccor_spectra(spectrum(ts1), spectrum(ts2), len(ts1))
 
 # def max_corr_at_phase(ts1, ts2):
 #     """ this is just for checking the max correlation with the kernelized cross-correlation """
@@ -74,14 +102,20 @@ def kernel_corr(ts1, ts2, mult=1):
     of a time series with itself is 1. We'll set the default multiplier to 1.
     """
 
+    if len(ts1) != len(ts2):
+        raise ValueError("ts1 must be the same length as ts2 to calculate cross correlation")
+
+    # transform each series once, and reuse the spectra for all three kernels
+    n = len(ts1)
+    X, Y = spectrum(ts1), spectrum(ts2)
+
     # calculate kernel
     # K(e^(m*ccor(ts1,ts2)))
-    kernel = np.sum(np.exp(mult * ccor(ts1, ts2)))
+    kernel = np.sum(np.exp(mult * ccor_spectra(X, Y, n)))
 
     # Calculate kernel normalization constant:
     # sqrt(K(x,x)K(y,y))
-    k_norm = np.sqrt(np.sum(np.exp(mult * ccor(ts1, ts1))) *
-                     np.sum(np.exp(mult * ccor(ts2, ts2))))
+    k_norm = np.sqrt(kernel_norms(X, n, mult) * kernel_norms(Y, n, mult))
 
     # return normalized kernel if k_norm is non-zero
     kernel_corr = kernel/k_norm if k_norm != 0 else 0
@@ -101,7 +135,7 @@ def kernel_dist(ts1, ts2, mult=1):
     """
 
     # Ensure the time series have already been standardized
-    if abs(ts1.mean()) >= .0001 or abs(ts2.mean()) >= .0001:
+    if abs(_values(ts1).mean()) >= .0001 or abs(_values(ts2).mean()) >= .0001:
         raise ValueError("time series must be standardized before calculating kernel distance")
 
     # Calculate the kernel correlation value for ts1 and ts2
@@ -111,3 +145,76 @@ def kernel_dist(ts1, ts2, mult=1):
     # (Where C = kernel correlation )
     # However, we are using normalized kernels here, so the dist^2 will be 2(1-C(ts1,ts2))
     return np.sqrt(2*(1-kernel_corr_val))
+
+def kernel_norms(spectra, length, mult=1):
+    """
+    Calculates the kernel of each time series with itself, K(x,x), from their spectra.
+    These only depend on the series, so callers can keep them with the series.
+
+    Args:
+        spectra: spectrum of one standardized time series, or one spectrum per row
+        length: length of the series the spectra came from
+        mult: multiplier factor. Defaults to 1. (Must be non-negative.)
+
+    Returns:
+        sum(exp(mult * ccor(x, x))) - a float, or an np.array with one per row
+    """
+    return np.sum(np.exp(mult * ccor_spectra(spectra, spectra, length)), axis=-1)
+
+def kernel_dist_many(query, matrix, mult=1, spectra=None, self_norms=None):
+    """
+    Calculates the kernel distance from one time series to many at once.
+
+    The query is transformed once, the candidates in one batched FFT, and all
+    cross-correlations come out of a single batched inverse FFT.
+
+    Args:
+        query: time series object or ndarray to measure from. (Must be standardized)
+        matrix: 2d array with the values of one candidate per row. (Rows must be standardized)
+        mult: multiplier factor. Defaults to 1. (Must be non-negative.)
+        spectra: spectrum of each row of matrix, if already known
+        self_norms: kernel_norms of the rows of matrix, if already known
+
+    Returns:
+        np.array - distance to each row, the same as kernel_dist(row, query)
+
+    Raises:
+        ValueError: if the rows are not as long as the query, or either is not standardized
+    """
+    values = _values(query)
+    matrix = np.atleast_2d(np.asarray(matrix, dtype=np.float64))
+    n = len(values)
+    if matrix.shape[1] != n:
+        raise ValueError("time series must be the same length to calculate kernel distance")
+    if abs(values.mean()) >= .0001 or np.any(np.abs(matrix.mean(axis=1)) >= .0001):
+        raise ValueError("time series must be standardized before calculating kernel distance")
+
+    if spectra is None:
+        spectra = spectrum(matrix)
+    if self_norms is None:
+        self_norms = kernel_norms(spectra, n, mult)
+
+    q_spectrum = spectrum(values)
+    return kernel_dist_spectra(spectra, q_spectrum, self_norms, kernel_norms(q_spectrum, n, mult), n, mult)
+
+def kernel_dist_spectra(X, Y, x_norms, y_norms, length, mult=1):
+    """
+    Calculates kernel distances between series given by their spectra and self terms,
+    row by row. The arguments broadcast like numpy arrays, so one query can be measured
+    against many series, or every query against every series (X[:, None], Y[None]).
+
+    Args:
+        X, Y: spectra of standardized series (see spectrum), one per row
+        x_norms, y_norms: kernel_norms of the rows of X and Y
+        length: length of the series the spectra came from
+        mult: multiplier factor. Defaults to 1. (Must be non-negative.)
+
+    Returns:
+        np.array - kernel distance between each pair of rows
+    """
+    kernels = np.sum(np.exp(mult * ccor_spectra(X, Y, length)), axis=-1)
+    k_norms = np.sqrt(x_norms * y_norms)
+    corrs = np.divide(kernels, k_norms, out=np.zeros_like(kernels), where=k_norms != 0)
+
+    # rounding can put the correlation of a series with itself a hair above 1
+    return np.sqrt(np.maximum(2 * (1 - corrs), 0))
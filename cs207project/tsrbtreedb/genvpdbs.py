@@ -44,7 +44,7 @@ def calc_distances(vp_k,timeseries_dict):
     return distances
 
 def save_vp_dbs(vp_tuple):
-    """ Creates unbalanced binary tree databases and saves them to disk"""
+    """ Creates red-black tree databases and saves them to disk"""
 
     vp,timeseries_dict, DB_DIR = vp_tuple
     sorted_ds = calc_distances(vp,timeseries_dict)
@@ -53,9 +53,8 @@ def save_vp_dbs(vp_tuple):
     db_filepath = DB_DIR + vp + ".dbdb"
     db = connect(db_filepath)
 
-    for dist_to_vp,ts_fn in sorted_ds:
-        db.set(dist_to_vp, ts_fn)
-
+    # Writing a balanced tree in one pass avoids the path copies of one set() per distance
+    db.bulk_load(sorted(sorted_ds))
     db.commit()
     db.close()
 
@@ -0,0 +1,133 @@
+#!/usr/local/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+knngraph.py
+
+Builds the k nearest neighbour graph of all stored light curves, e.g. for
+clustering and finding duplicates, without one similarity search per light curve.
+
+The light curves are split into blocks of rows, and worker processes find the
+neighbours of each block in the resident corpus (see corpus.py) with batched
+kernel distances from crosscorr. A few light curves serve as pivots: their
+distances give triangle inequality lower bounds that rule out most pairs without
+scoring them. Memory stays bounded by the block size and max_pairs.
+
+The graph is written to an output dir as three .npy files:
+    knn_ids.npy         light curve id of each row
+    knn_neighbors.npy   (n, k) int32 rows of the k nearest neighbours of each row, nearest first
+    knn_dists.npy       (n, k) float32 kernel distances to those neighbours
+
+Main functions:
+    - build_knn_graph       Computes the graph of a light curve dir and writes it to disk
+    - load_knn_graph        Opens a written graph (memory mapped)
+
+"""
+
+import os
+import random
+import numpy as np
+from numpy.lib.format import open_memmap
+from cs207project.tsrbtreedb.corpus import get_corpus
+from cs207project.tsrbtreedb.simsearch import worker_pool
+
+IDS_FN = "knn_ids.npy"
+NEIGHBORS_FN = "knn_neighbors.npy"
+DISTS_FN = "knn_dists.npy"
+
+# Number of light curves picked as pivots for the triangle inequality bounds
+N_PIVOTS = 16
+
+def build_knn_graph(lc_dir, out_dir, k=5, block=256, max_pairs=1 << 16, n_pivots=N_PIVOTS):
+    """
+    Computes the k nearest neighbours of every light curve in lc_dir, and writes
+    the graph to out_dir (see the module docstring for the files).
+
+    Args:
+        lc_dir: light curve dir to build the graph of
+        out_dir: dir to write the graph to (created if needed)
+        k: number of neighbours per light curve (not counting itself)
+        block: number of light curves per task sent to the worker processes
+        max_pairs: most (row, column) distances a worker holds in memory at a time
+        n_pivots: number of light curves used as vantage points to skip distances
+    Returns:
+        Number of light curves in the graph
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    corpus = get_corpus(lc_dir)
+    ids = corpus.ids[:]
+    np.save(os.path.join(out_dir, IDS_FN), np.array(ids, dtype=str))
+    pivots = sorted(random.Random(0).sample(ids, min(n_pivots, len(ids))))
+
+    n = len(ids)
+    k = min(k, max(n - 1, 0))
+    neighbors = open_memmap(os.path.join(out_dir, NEIGHBORS_FN), mode='w+', dtype=np.int32, shape=(n, k))
+    dists = open_memmap(os.path.join(out_dir, DISTS_FN), mode='w+', dtype=np.float32, shape=(n, k))
+
+    # workers of a shared pool may still hold a corpus loaded before the light
+    # curves were regenerated, so they are told which one to use
+    tasks = [(lc_dir, corpus.generation, out_dir, lo, min(lo + block, n), k, pivots, max_pairs)
+             for lo in range(0, n, block)]
+    with worker_pool() as pool:
+        for lo, block_neighbors, block_dists in pool.map(knn_block, tasks):
+            neighbors[lo:lo + len(block_neighbors)] = block_neighbors
+            dists[lo:lo + len(block_dists)] = block_dists
+
+    neighbors.flush()
+    dists.flush()
+    del neighbors, dists
+    return n
+
+def knn_block(task):
+    """
+    Worker function called by build_knn_graph above. Finds the k nearest
+    neighbours of rows lo to hi of the graph with Corpus.nearest_many, which
+    scores (row, column) pairs in batches of max_pairs and skips the pairs that
+    the pivots show cannot be among the k nearest.
+    """
+    lc_dir, generation, out_dir, lo, hi, k, pivots, max_pairs = task
+    corpus = get_corpus(lc_dir, generation)
+    ids, positions = _graph_ids(out_dir)
+    q_values = corpus.values[corpus.rows(ids[lo:hi])]
+
+    # one more than k, as each light curve finds itself (or an exact duplicate)
+    nearest = corpus.nearest_many(q_values, ids, k + 1, pivots, max_pairs)
+
+    block_neighbors = np.empty((hi - lo, k), dtype=np.int32)
+    block_dists = np.empty((hi - lo, k), dtype=np.float32)
+    for i, row_nearest in enumerate(nearest):
+        own_id = ids[lo + i]
+        others = [(d, ts_id) for d, ts_id in row_nearest if ts_id != own_id][:k]
+        block_neighbors[i] = [positions[ts_id] for _, ts_id in others]
+        block_dists[i] = [d for d, _ in others]
+    return (lo, block_neighbors, block_dists)
+
+# Ids of the graph rows in a worker process, by output dir,
+# as (ids file mtime, ids, {id: row})
+_worker_graphs = {}
+
+def _graph_ids(out_dir):
+    """
+    Returns the ids of the graph being written to out_dir, in row order, and a
+    dict from id to row. They are read once per graph in each worker.
+    """
+    ids_path = os.path.join(out_dir, IDS_FN)
+    mtime = os.path.getmtime(ids_path)
+    cached = _worker_graphs.get(out_dir)
+    if cached is None or cached[0] != mtime:
+        ids = np.load(ids_path).tolist()
+        cached = _worker_graphs[out_dir] = (mtime, ids, {ts_id: row for row, ts_id in enumerate(ids)})
+    return cached[1], cached[2]
+
+def load_knn_graph(out_dir):
+    """
+    Opens a graph written by build_knn_graph. The arrays are memory mapped, so
+    rows are only read from disk when used.
+
+    Returns:
+        Tuple: ids, neighbors and dists arrays (see the module docstring)
+    """
+    ids = np.load(os.path.join(out_dir, IDS_FN))
+    neighbors = np.load(os.path.join(out_dir, NEIGHBORS_FN), mmap_mode='r')
+    dists = np.load(os.path.join(out_dir, DISTS_FN), mmap_mode='r')
+    return (ids, neighbors, dists)
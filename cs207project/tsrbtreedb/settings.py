@@ -8,11 +8,13 @@ the simsearch and socket0server modal.
 
 LIGHT_CURVES_DIR = "light_curves/"
 DB_DIR = "vp_dbs/"
+VPTREE_FN = "vptree.npz" #VP-tree index file, kept in DB_DIR
 SAMPLE_DIR = "sample_data/"
 TEMP_DIR = "temp/"
 TS_LENGTH = 100 #Number of data points for generated time series
 PORT = 20042 #Port used by socket server
 SOCKET_SERVER_IP ='localhost'
+WORKER_PROCESSES = None #Number of processes in the simsearch worker pool (None for one per cpu)
 
 
 def tsid_to_fn(tsid):
@@ -9,25 +9,36 @@ Contains the main functions for creating, adding, and searching the light curve
 Main functions:
     - load_external_ts          Loads space delimited time series text file from disk to be searched on.
     - rebuild_lcs_dbs           Regenerate light curves and rebuild vp indexes
-    - search_vpdb_for_n         Uses parallel process to search for n most similar light curves
+    - find_nearest              Best-first search for the k most similar light curves
+    - search_vpdb_for_n         Finds the n most similar light curves, and whether the time series is already stored
+    - search_many_for_n         Finds the n most similar light curves to each of many time series at once
+    - build_vptree              Builds and saves a VP-tree index over all light curves
+    - search_vptree_for_n       Same as search_vpdb_for_n, but searches the VP-tree index
     - add_ts_to_vpdbs           Adds single new time series to vp indexes
+    - add_many_ts_to_vpdbs      Adds many new time series to vp indexes in one batch per index
+    - start_worker_pool         Starts the process pool shared by adds (e.g. at server startup)
+    - shutdown_worker_pool      Stops the shared process pool
 
 """
 
 import os
 import heapq
+from itertools import islice, takewhile
+from contextlib import contextmanager
 from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-from cs207project.tsrbtreedb.crosscorr import standardize, kernel_dist
+from cs207project.tsrbtreedb.crosscorr import standardize, standardize_rows, kernel_dist
 from cs207project.tsrbtreedb.makelcs import make_lcs_wfm
 from cs207project.tsrbtreedb.genvpdbs import create_vpdbs
+from cs207project.tsrbtreedb.corpus import get_corpus, add_to_corpus, clear_corpora, BOUND_SLACK
+from cs207project.tsrbtreedb.vptree import VPTree, LEAF_SIZE
 from cs207project.rbtree.redblackDB import connect
 from cs207project.storagemanager.filestoragemanager import FileStorageManager
 import cs207project.timeseries.arraytimeseries as ats
 
 # Global variables
 
-from cs207project.tsrbtreedb.settings import TS_LENGTH, tsfn_to_id, tsid_to_fn
+from cs207project.tsrbtreedb.settings import TS_LENGTH, WORKER_PROCESSES, VPTREE_FN, tsfn_to_id, tsid_to_fn
 
 ### Helper functions ###
 
@@ -54,6 +65,10 @@ def load_ts_wo_fm(ts_id,lc_dir):
     return load_ts(ts_id,fsm)
 
 
+def list_vps(db_dir):
+    """Returns the ids of the vantage points, based on names of vantage point db files"""
+    return [file[:-5] for file in os.listdir(db_dir) if file.startswith("ts_datafile_") and file.endswith(".dbdb")]
+
 def load_vp_lcs(db_dir, lc_dir):
     """
     Based on names of vantage point db files loads and returns time series curves
@@ -62,42 +77,32 @@ def load_vp_lcs(db_dir, lc_dir):
     vp_dict={}
     fsm = FileStorageManager(lc_dir)
 
-    for file in os.listdir(db_dir):
-        if file.startswith("ts_datafile_") and file.endswith(".dbdb"):
-            lc_id = file[:-5]
-            vp_dict[lc_id] = load_ts(lc_id, fsm)
+    for lc_id in list_vps(db_dir):
+        vp_dict[lc_id] = load_ts(lc_id, fsm)
 
     return vp_dict
 
-def find_closest_vp(vps_dict, ts):
+def find_closest_vp(vps, ts, lc_dir=None):
     """
     Calculates distances from time series to all vantage points.
     Returns tuple with filename of closest vantage point and distance to that vantage point.
+
+    Args:
+        vps: dict of vantage point time series keyed by filename (see load_vp_lcs), or
+            with lc_dir, any collection of vantage point filenames (see list_vps)
+        ts: time series to search on.
+        lc_dir: if given, measure to the vantage points in the resident corpus of lc_dir
+            instead of standardizing them again.
     """
     s_ts = standardize(ts)
-    vp_distances = sorted([(kernel_dist(s_ts, standardize(vps_dict[vp])),vp) for vp in vps_dict])
+    if lc_dir is not None:
+        vp_fns = sorted(vps)
+        vp_distances = sorted(zip(get_corpus(lc_dir).kernel_dists(s_ts, vp_fns), vp_fns))
+    else:
+        vp_distances = sorted([(kernel_dist(s_ts, standardize(vps[vp])),vp) for vp in vps])
     dist_to_vp, vp_fn = vp_distances[0]
     return (vp_fn,dist_to_vp)
 
-def find_lc_candidates(vp_t, db_dir, lc_dir):
-    """
-    Identifies light curves in selected vantage db that are up to 2x the distance
-    that the time series is from the vantage point
-
-    Returns tuple with list of light curve candidates and file storage manager object
-    """
-
-    fsm = FileStorageManager(lc_dir)
-
-    vp_fn, dist_to_vp = vp_t
-
-    db = connect(db_dir + vp_fn + ".dbdb")
-    lc_candidates = db.chop(2 * dist_to_vp)
-    db.close()
-
-    return (lc_candidates,fsm)
-
-
 def load_external_ts(filepath):
     """
     Loads space delimited time series text file from disk to be searched on.
@@ -156,14 +161,147 @@ def need_to_rebuild(lc_dir, db_dir):
 def rebuild_lcs_dbs(lc_dir, db_dir, n_vps=20, n_lcs=1000):
     """Regenerate light curves and rebuild vp indexes"""
     print("\nRebuilding simulated light curves and vantage point index files....\n(This may take up to 30 seconds)")
+    # the regenerated light curves reuse the ids of the old ones
+    clear_corpora()
     make_lcs_wfm(n_lcs, lc_dir)
     create_vpdbs(n_vps,lc_dir,db_dir)
+    build_vptree(db_dir,lc_dir)
     print("Indexes rebuilt.\n")
 
+### Worker pool ###
+
+# Shared process pool, see start_worker_pool()
+_pool = None
+
+# File storage managers of a worker process, by light curve dir
+_worker_fsms = {}
+
+def start_worker_pool(max_workers=WORKER_PROCESSES):
+    """
+    Starts the process pool used to add time series, if it is not running yet.
+    Without it every call starts (and stops) a pool of its own.
+
+    Args:
+        max_workers: number of worker processes (None for one per cpu)
+    Returns:
+        The shared ProcessPoolExecutor
+    """
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=max_workers)
+    return _pool
+
+def shutdown_worker_pool():
+    """Stops the shared process pool, waiting for running tasks to finish"""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None
+
+@contextmanager
+def worker_pool():
+    """Yields the shared process pool if it is running, otherwise a pool just for this call"""
+    if _pool is not None:
+        yield _pool
+    else:
+        with ProcessPoolExecutor(max_workers=WORKER_PROCESSES) as pool:
+            yield pool
+
+def load_ts_in_worker(ts_id, lc_dir):
+    """
+    Loads a time series in a worker process. The file storage manager of lc_dir
+    is kept for later tasks, and reloaded if it does not know ts_id yet
+    (i.e. the time series was added after it was loaded).
+    """
+    fsm = _worker_fsms.get(lc_dir)
+    ts = fsm.get(ts_id) if fsm is not None else None
+    if ts is None:
+        fsm = _worker_fsms[lc_dir] = FileStorageManager(lc_dir)
+        ts = load_ts(ts_id, fsm)
+    return ts
+
 #####################################################
 ###    Main functions for similarity searching    ###
 #####################################################
 
+def find_nearest(vp_t, ts, db_dir, lc_dir, k, block=16):
+    """
+    Best-first search for the k light curves closest to a time series.
+
+    Light curves are visited outward from the time series' distance to the
+    vantage point in its vantage point db, i.e. in order of increasing lower bound
+    |d(q, vp) - d(x, vp)|. Each visited block is pruned further with the bounds from
+    all the vantage points (see Corpus.lower_bounds), and the rest are scored against
+    the resident corpus. A max-heap keeps the best k, and the search stops as soon
+    as the next lower bound is beyond the k-th best distance. If the bounds prune
+    nothing in the first block, the rest of the ball is scored in one batch instead.
+
+    Args:
+        vp_t: tuple containing vantage point filename and distance of time series to vantage point
+        ts: time series to search on.
+        k: number of closest light curves to find
+        block: number of light curves to visit in the first block (doubles after each block)
+    Returns:
+        List of (distance, ts filename) tuples for the k closest light curves, closest first
+    """
+    vp_fn, dist_to_vp = vp_t
+    s_ts = standardize(ts)
+    corpus = get_corpus(lc_dir)
+    vp_fns = sorted(list_vps(db_dir))
+    q_to_vps = corpus.kernel_dists(s_ts, vp_fns)
+
+    # max-heap of the k best so far, as (-distance, ts_fn). The vantage point is
+    # not in its own db, and its distance is already known.
+    heap = [(-dist_to_vp, vp_fn)]
+    kth_best = lambda: -heap[0][0] if len(heap) == k else np.inf
+
+    def consider(dists, ts_fns):
+        # only the k closest of a batch can be among the k closest overall
+        if len(dists) > k:
+            closest = np.argpartition(dists, k - 1)[:k]
+            dists, ts_fns = dists[closest], [ts_fns[i] for i in closest]
+        for dist, ts_fn in zip(dists, ts_fns):
+            if len(heap) < k:
+                heapq.heappush(heap, (-dist, ts_fn))
+            elif dist < kth_best():
+                heapq.heapreplace(heap, (-dist, ts_fn))
+
+    db = connect(db_dir + vp_fn + ".dbdb", use_mmap=True)
+    try:
+        cursor = db.iter_nearest(dist_to_vp)
+        first_block = True
+        while True:
+            visited = list(islice(cursor, block))
+            # keys come in order of the single vantage point bound, so the first
+            # one beyond the k-th best distance ends the search
+            bound_cutoff = kth_best() + BOUND_SLACK
+            candidates = [ts_fn for d_to_vp, ts_fn in visited if abs(d_to_vp - dist_to_vp) <= bound_cutoff]
+            done = len(candidates) < block
+
+            bounds = corpus.lower_bounds(q_to_vps, candidates, vp_fns) if candidates else []
+            candidates = [ts_fn for ts_fn, bound in zip(candidates, bounds) if bound <= bound_cutoff]
+            if candidates:
+                consider(corpus.kernel_dists(s_ts, candidates), candidates)
+            if done:
+                break
+
+            if first_block and len(heap) == k and np.all(bounds <= kth_best() + BOUND_SLACK):
+                # the bounds rule out none of the nearest light curves, so they are
+                # unlikely to rule out the farther ones either (e.g. when distances
+                # are tightly clustered): score the rest of the ball in one batch
+                # rather than walking it block by block
+                radius = kth_best() + BOUND_SLACK
+                rest = [ts_fn for _, ts_fn in takewhile(lambda item: abs(item[0] - dist_to_vp) <= radius, cursor)]
+                if rest:
+                    consider(corpus.kernel_dists(s_ts, rest), rest)
+                break
+            first_block = False
+            block *= 2
+    finally:
+        db.close()
+
+    return sorted((-neg_dist, ts_fn) for neg_dist, ts_fn in heap)
+
 def search_vpdb_for_n(vp_t, ts, db_dir, lc_dir, n):
     """
     Searches for n most similar light curve based on pre-computed distances in vpdb
@@ -175,27 +313,68 @@ def search_vpdb_for_n(vp_t, ts, db_dir, lc_dir, n):
         Dict: A dict of n closet time series ids, with distances as the keys and ts ids as the values
 
     Note:
-        Uses processes pool to calculate distances in parallel, and heap queue data to minimize time
-        for sorting final distance list to n smallest distances.
+        Uses find_nearest, so the work done grows with how many light curves lie about as
+        far from the vantage point as the time series does, not with a fixed radius.
     """
 
-    # 1. Setup data to be processed in parallel
-    vp_fn, dist_to_vp = vp_t
-    lc_candidates,fsm = find_lc_candidates(vp_t,db_dir,lc_dir)
-    lc_candidates.append((dist_to_vp,vp_fn))
-    existing_ts_id = -1
-    s_ts = standardize(ts)
+    # 1. Find the n+1 closest light curves, best first
+    nearest = find_nearest(vp_t, ts, db_dir, lc_dir, n+1)
+
+    # 2. Return n_smallest dict, and exiting id (or -1 if not in db)
+    return split_existing_ts(nearest)
 
-    lc_candidate_data = [(ts_fn,fsm,s_ts) for d_to_vp,ts_fn in lc_candidates]
+def search_many_for_n(ts_list, db_dir, lc_dir, n):
+    """
+    Searches for the n most similar light curves to each of many time series at once.
 
-    # 2. Calculate distances in parallel
-    with ProcessPoolExecutor() as pool:
-        dist_list = pool.map(calc_distance, lc_candidate_data)
+    All time series are standardized together and assigned to their closest vantage
+    point in one pass. Each vantage point db is then read once for all the time
+    series closest to it, and their distances to its light curves are scored in
+    batches (see Corpus.nearest_many).
+
+    Args:
+        ts_list: time series to search on (all TS_LENGTH long)
+        n: number of similar light curves to find per time series
+    Returns:
+        List with a (dict of n closest ts ids keyed by distance, existing id or -1)
+        tuple per time series, the same as search_vpdb_for_n gives
+    """
+    if not ts_list:
+        return []
+    corpus = get_corpus(lc_dir)
+    vp_fns = sorted(list_vps(db_dir))
+    q_values = standardize_rows([ts.values() for ts in ts_list])
+
+    # closest vantage point of every time series (ties go to the first filename, as in find_closest_vp)
+    closest = np.argmin(corpus.kernel_dist_matrix(q_values, vp_fns), axis=1)
+
+    results = [None] * len(ts_list)
+    for vp_i in np.unique(closest):
+        vp_fn = vp_fns[vp_i]
+        db = connect(db_dir + vp_fn + ".dbdb", use_mmap=True)
+        candidate_fns = [ts_fn for _, ts_fn in db.range()] + [vp_fn]
+        db.close()
+
+        queries = np.flatnonzero(closest == vp_i)
+        nearest = corpus.nearest_many(q_values[queries], candidate_fns, n+1, vp_fns)
+        for q, q_nearest in zip(queries, nearest):
+            results[q] = split_existing_ts(q_nearest)
+    return results
+
+def split_existing_ts(nearest):
+    """
+    Splits the n+1 closest light curves found by a search into the n closest and
+    the id of the light curve that is the time series itself, if it is stored.
 
-    # 3. Sort distances for n+1 smallest
-    n_smallest = heapq.nsmallest(n+1, dist_list)
+    Args:
+        nearest: list of (distance, ts filename) tuples for the n+1 closest light curves
+    Returns:
+        Tuple: dict of n closest time series ids keyed by distance, and existing id (or -1 if not in db)
+    """
+    existing_ts_id = -1
+    n_smallest = [(dist, tsfn_to_id(ts_fn)) for dist, ts_fn in nearest]
 
-    # 4. Look through sublist of closest time series to see if any of have a distance of zero.
+    # Look through sublist of closest time series to see if any of have a distance of zero.
     # If so, mark it as an existing time series.
     # Otherwise, trim the list by 1.
     for dist_to_ts,tsid in n_smallest:
@@ -207,16 +386,62 @@ def search_vpdb_for_n(vp_t, ts, db_dir, lc_dir, n):
     else:
         n_smallest = [(d,id) for d,id in n_smallest if (id != existing_ts_id)]
 
-    # 5. Return n_smallest dict, and exiting id (or -1 if not in db)
     return (dict(n_smallest),existing_ts_id)
 
-def calc_distance(lc_candidate_data):
-    """Working function called by search_vpdb_for_n above"""
-    ts_fn,fsm,s_ts = lc_candidate_data
-    candidate_ts = load_ts(ts_fn,fsm)
-    dist_to_ts = kernel_dist(standardize(candidate_ts),s_ts)
-    return(dist_to_ts,tsfn_to_id(ts_fn))
+# Loaded VP-trees by file path, as (file mtime, VPTree), see load_vptree()
+_vptrees = {}
+
+def build_vptree(db_dir, lc_dir, leaf_size=LEAF_SIZE):
+    """
+    Builds a VP-tree (see vptree.py) over all light curves in lc_dir, and saves it
+    to db_dir as VPTREE_FN next to the vantage point dbs.
+
+    Returns:
+        The VPTree
+    """
+    corpus = get_corpus(lc_dir)
+    corpus.refresh()
+    tree = VPTree.build(corpus, leaf_size)
+    tree.save(db_dir + VPTREE_FN)
+    _vptrees.pop(db_dir + VPTREE_FN, None)
+    return tree
+
+def load_vptree(db_dir, lc_dir=None):
+    """
+    Returns the VP-tree saved in db_dir. It is read from disk once, and again
+    only when the file changes.
+
+    If db_dir has no tree (e.g. the vantage point dbs were rebuilt by create_vpdbs,
+    which clears db_dir) and lc_dir is given, a tree over lc_dir is built and saved.
+
+    Raises:
+        FileNotFoundError: if there is no tree, and no lc_dir to build one from
+    """
+    path = db_dir + VPTREE_FN
+    if lc_dir is not None and not os.path.exists(path):
+        build_vptree(db_dir, lc_dir)
+    mtime = os.path.getmtime(path)
+    cached = _vptrees.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = _vptrees[path] = (mtime, VPTree.load(path))
+    return cached[1]
+
+def search_vptree_for_n(ts, db_dir, lc_dir, n):
+    """
+    Searches for n most similar light curves with the VP-tree saved in db_dir
+    (see build_vptree). Light curves added since the tree was built are still found.
 
+    Args:
+        ts: time series to search on.
+    Returns:
+        Same as search_vpdb_for_n: dict of n closest time series ids keyed by distance,
+        and the id of the time series if it is already stored (or -1)
+    """
+    # pick up light curves stored by other processes, which the tree cannot know about
+    corpus = get_corpus(lc_dir)
+    corpus.refresh()
+    nearest = load_vptree(db_dir, lc_dir).nearest(corpus, standardize(ts), n+1)
+    return split_existing_ts(nearest)
 
 def search_vpdb(vp_t, ts, db_dir, lc_dir):
     """
@@ -245,7 +470,7 @@ def ts_already_exists(ts, db_dir, lc_dir):
 
     Returns tsid (e.g., 456) if it finds a matching time series, -1 otherwise
     """
-    vp_t = find_closest_vp(load_vp_lcs(db_dir,lc_dir),ts)
+    vp_t = find_closest_vp(list_vps(db_dir),ts,lc_dir)
     _ ,existing_ts_id = search_vpdb_for_n(vp_t, ts, db_dir, lc_dir, 5)
 
     return existing_ts_id
@@ -259,32 +484,46 @@ def add_ts_to_vpdbs(ts, ts_fn, db_dir, lc_dir):
     Based on names of vantage point db files, adds single new time series to vp indexes
     (Does not re-pick vantage points)
 
-    Uses ProcessPoolExecutor to run processes in parallel.
+    Uses the worker pool to run processes in parallel.
     """
+    add_many_ts_to_vpdbs([ts], [ts_fn], db_dir, lc_dir)
 
-    fsm = FileStorageManager(lc_dir)
-    s_ts = standardize(ts)
+def add_many_ts_to_vpdbs(ts_list, ts_fns, db_dir, lc_dir):
+    """
+    Adds many new time series to the vp indexes at once.
+    (Does not re-pick vantage points)
+
+    Each vantage point db is opened once and all of its new entries are written
+    in a single batched transaction, rather than committing once per time series.
+    The time series are also added to the resident corpus of lc_dir, if it is loaded.
+
+    Args:
+        ts_list: list of time series to add
+        ts_fns: filenames the time series are stored under, in the same order as ts_list
+    """
+
+    add_to_corpus(lc_dir, ts_fns, ts_list)
+    s_ts_list = [standardize(ts) for ts in ts_list]
 
     # Setup data for process poll execution
-    vp_fns  = [file for file in os.listdir(db_dir) if file.startswith("ts_datafile_") and file.endswith(".dbdb")]
-    vp_tuples = [(vp_fn,fsm,s_ts,ts_fn,db_dir) for vp_fn in vp_fns]
+    vp_tuples = [(vp_fn + ".dbdb",lc_dir,s_ts_list,ts_fns,db_dir) for vp_fn in list_vps(db_dir)]
 
-    # Create processes
-    with ProcessPoolExecutor() as pool:
-        _ = pool.map(add_ts_to_vpdb,vp_tuples)
+    # Run in worker processes, waiting for all of them (and raising their errors)
+    with worker_pool() as pool:
+        list(pool.map(add_ts_to_vpdb,vp_tuples))
 
 def add_ts_to_vpdb(data_tuple):
     """
-    Worker function called by add_ts_to_vpdbs above.
+    Worker function called by add_many_ts_to_vpdbs above.
     This process is repeated on each vantage point.
     """
-    file,fsm,s_ts,ts_fn,db_dir = data_tuple
-    vp_ts = load_ts(file[:-5],fsm)
-    dist_to_vp = kernel_dist(standardize(vp_ts), s_ts)
-    # print("Adding " + ts_fn + " to " + (db_dir + file))
+    file,lc_dir,s_ts_list,ts_fns,db_dir = data_tuple
+    vp_ts = standardize(load_ts_in_worker(file[:-5],lc_dir))
+    # print("Adding " + str(ts_fns) + " to " + (db_dir + file))
     db = connect(db_dir + file)
-    db.set(dist_to_vp,ts_fn)
-    db.commit()
+    with db.batch():
+        for s_ts, ts_fn in zip(s_ts_list, ts_fns):
+            db.set(kernel_dist(vp_ts, s_ts), ts_fn)
     db.close()
 
 if __name__ == "__main__":
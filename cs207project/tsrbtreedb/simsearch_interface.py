@@ -12,6 +12,7 @@ Main functions:
     add_ts                      Save new time series to database
     simsearch_by_id             Find nearest n time series for submitted time series
     simsearch_by_ts             Find nearest n time series for  existing id
+    simsearch_many              Find nearest n time series for each of many submitted time series
     rebuild_vp_indexs           Rebuilds vantage point databases, based on existing time series saved to disk
 
 """
@@ -107,7 +108,7 @@ def simsearch_by_id(id,n=5):
     except IOError:
         raise ValueError("No time series with that id")
     else:
-        closest_vp = simsearch.find_closest_vp(simsearch.load_vp_lcs(DB_DIR,LIGHT_CURVES_DIR), input_ts)
+        closest_vp = simsearch.find_closest_vp(simsearch.list_vps(DB_DIR), input_ts, LIGHT_CURVES_DIR)
         return simsearch.search_vpdb_for_n(closest_vp,input_ts,DB_DIR,LIGHT_CURVES_DIR,n)[0]
 
 def simsearch_by_ts(ts,n=5):
@@ -142,7 +143,7 @@ def simsearch_by_ts(ts,n=5):
     is_new = False
     fsm = FileStorageManager(LIGHT_CURVES_DIR)
     interpolated_ats = sanitize_ats(ts)
-    closest_vp = simsearch.find_closest_vp(simsearch.load_vp_lcs(DB_DIR,LIGHT_CURVES_DIR),interpolated_ats)
+    closest_vp = simsearch.find_closest_vp(simsearch.list_vps(DB_DIR),interpolated_ats,LIGHT_CURVES_DIR)
     n_closest_dict, tsid = simsearch.search_vpdb_for_n(closest_vp,interpolated_ats,DB_DIR,LIGHT_CURVES_DIR,n)
 
     if tsid == -1:
@@ -151,11 +152,43 @@ def simsearch_by_ts(ts,n=5):
 
     return (n_closest_dict,tsid,is_new)
 
+def simsearch_many(list_of_ts, n=5):
+    """
+    Args:
+        list_of_ts: array time series objects to search on
+        n: number of time series to return per time series. (Defaults to 5)
+
+    Returns:
+        Returns a list with a two element tuple per submitted time series:
+         - First element is a dictionary of the n closest time series ids keyed by
+        distances.
+         - Second element is the id of the time series if it is already in the
+         database, or -1 if it is not.
+
+        Example: [({.456:"ts_425",.3021:"ts_537"},-1), ({.398:"ts_211",.4102:"ts_36"},1201)]
+
+    Notes:
+
+        Unlike simsearch_by_ts, new time series are not saved to the database.
+        All the time series are searched together, which is much faster than one
+        simsearch_by_ts call each.
+
+    """
+
+    # Confirm indexes and time series files already exist
+    rebuild_if_needed(LIGHT_CURVES_DIR,DB_DIR)
+
+    interpolated = [sanitize_ats(ts) for ts in list_of_ts]
+    return simsearch.search_many_for_n(interpolated,DB_DIR,LIGHT_CURVES_DIR,n)
+
 def rebuild_vp_indexs(n=20):
     """
     Rebuilds vantage point "databases" based on time series that have been
     saved to disk. May take some time(up to 30 seconds in my experience)
 
+    The VP-tree is rebuilt too, so it indexes every time series added since.
+
     """
     simsearch.create_vpdbs(n,LIGHT_CURVES_DIR,DB_DIR)
+    simsearch.build_vptree(DB_DIR,LIGHT_CURVES_DIR)
 
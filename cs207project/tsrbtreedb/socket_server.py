@@ -1,12 +1,14 @@
 # SERVER
 
 import json
+import atexit
 import numpy as np
 from socketserver import BaseRequestHandler, TCPServer
 from cs207project.socketclient.serialization import serialize, Deserializer
 import cs207project.timeseries.arraytimeseries as ats
 from cs207project.tsrbtreedb.simsearch_interface import simsearch_by_id, simsearch_by_ts, rebuild_vp_indexs, get_by_id, add_ts,rebuild_if_needed
-from cs207project.tsrbtreedb.settings import LIGHT_CURVES_DIR, DB_DIR, PORT
+from cs207project.tsrbtreedb.simsearch import start_worker_pool, shutdown_worker_pool
+from cs207project.tsrbtreedb.settings import LIGHT_CURVES_DIR, DB_DIR, PORT, WORKER_PROCESSES
 
 class SocketServer(BaseRequestHandler):
     """
@@ -87,5 +89,8 @@ class SocketServer(BaseRequestHandler):
 
 if __name__ == '__main__':
     rebuild_if_needed(LIGHT_CURVES_DIR, DB_DIR)
+    # start worker processes once, instead of for every request
+    start_worker_pool(WORKER_PROCESSES)
+    atexit.register(shutdown_worker_pool)
     serv = TCPServer(('', PORT), SocketServer)
     serv.serve_forever()
@@ -53,6 +53,26 @@ class BinaryNodeRef(ValueRef):
         if self._referent:
             self._referent.store_refs(storage)
 
+    def store(self, storage):
+        "store this node and all unsaved nodes below it, children first"
+        # an explicit stack instead of prepare_to_store recursion, since an
+        # unbalanced tree can be as deep as it has nodes
+        stack = [self]
+        while stack:
+            ref = stack[-1]
+            node = ref._referent
+            if node is None or ref._address:
+                stack.pop()
+                continue
+            unsaved = [child for child in (node.left_ref, node.right_ref)
+                       if child._referent is not None and not child._address]
+            if unsaved:
+                stack.extend(unsaved)
+                continue
+            stack.pop()
+            node.value_ref.store(storage)
+            ref._address = storage.write(ref.referent_to_bytes(node))
+
     @staticmethod
     def referent_to_bytes(referent):
         "use pickle to convert node to bytes"
@@ -152,23 +172,32 @@ class BinaryTree(object):
 
     def _insert(self, node, key, value_ref):
         "insert a new node creating a new path from root"
+        #walk down recording the path, then copy it bottom up (no recursion,
+        #as sorted inserts make the tree as deep as it has nodes)
+        path = []
+        while node is not None:
+            if key < node.key:
+                path.append((node, True))
+                node = self._follow(node.left_ref)
+            elif key > node.key:
+                path.append((node, False))
+                node = self._follow(node.right_ref)
+            else:
+                break
         #create a tree ifnthere was none so far
         if node is None:
             new_node = BinaryNode(
                 BinaryNodeRef(), key, value_ref, BinaryNodeRef())
-        elif key < node.key:
-            new_node = BinaryNode.from_node(
-                node,
-                left_ref=self._insert(
-                    self._follow(node.left_ref), key, value_ref))
-        elif key > node.key:
-            new_node = BinaryNode.from_node(
-                node,
-                right_ref=self._insert(
-                    self._follow(node.right_ref), key, value_ref))
         else: #create a new node to represent this data
             new_node = BinaryNode.from_node(node, value_ref=value_ref)
-        return BinaryNodeRef(referent=new_node)
+        new_ref = BinaryNodeRef(referent=new_node)
+        for parent, went_left in reversed(path):
+            if went_left:
+                new_node = BinaryNode.from_node(parent, left_ref=new_ref)
+            else:
+                new_node = BinaryNode.from_node(parent, right_ref=new_ref)
+            new_ref = BinaryNodeRef(referent=new_node)
+        return new_ref
 
     # delete functionality will not be available for red black trees
     # for symmetry remove it from unbalanced binary search tree
@@ -277,14 +306,17 @@ class BinaryTree(object):
     # NEW METHOD 4
     def traverse_in_order(self, node):
         "traverse the tree from a node returning visited nodes in a list"
+        #explicit stack instead of recursion
         out_global = []
-        def traverse_enclosed(node):
-            if node is None:
-                return
-            traverse_enclosed(self._follow(node.left_ref))
-            out_global.append((node.key, self._follow(node.value_ref)))
-            traverse_enclosed(self._follow(node.right_ref))
-        traverse_enclosed(node)
+        stack = []
+        while stack or node is not None:
+            if node is not None:
+                stack.append(node)
+                node = self._follow(node.left_ref)
+            else:
+                node = stack.pop()
+                out_global.append((node.key, self._follow(node.value_ref)))
+                node = self._follow(node.right_ref)
         return out_global
 
     # NEW METHOD 5
@@ -317,7 +349,7 @@ class BinaryTree(object):
         for node in nodes_to_expand:
             if node.key<=chop_key:
                 out.append((node.key, self._follow(node.value_ref)))
-            out = out + self.traverse_in_order(self._follow(node.left_ref))
+            out.extend(self.traverse_in_order(self._follow(node.left_ref)))
         return out
 
 class Storage(object):
@@ -0,0 +1,183 @@
+#!/usr/local/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+vptree.py
+
+A vantage point tree over the light curves of a corpus (see corpus.py). Each
+node picks a vantage point, and splits the light curves below it at their median
+kernel distance to it: the nearer half goes inside, the farther half outside.
+A k nearest neighbour search only descends into the halves that the triangle
+inequality cannot rule out, so its expected cost grows logarithmically with the
+number of light curves.
+
+The tree is kept as flat numpy arrays, and saved to disk as a single .npz file.
+
+Main functions:
+    - VPTree.build          Builds a tree over all light curves of a corpus
+    - VPTree.load           Loads a tree saved with VPTree.save
+    - VPTree.nearest        Finds the k light curves closest to a time series
+
+"""
+
+import heapq
+import random
+import numpy as np
+from cs207project.tsrbtreedb.crosscorr import kernel_dist_many
+from cs207project.tsrbtreedb.corpus import BOUND_SLACK
+
+# Light curves in a node at or below this size are kept as a leaf bucket
+LEAF_SIZE = 32
+
+
+class VPTree(object):
+    """
+    Vantage point tree, as flat arrays indexed by node number (the root is node 0).
+
+    Attributes:
+        ids: light curve ids in the tree; the other arrays refer to them by position
+        vp: position in ids of the vantage point of each node, or -1 for a leaf
+        inside, outside: node numbers of the nearer and farther halves
+        inside_max: largest distance from the vantage point to a light curve inside
+        outside_min: smallest distance from the vantage point to a light curve outside
+        start, stop: for a leaf, the slice of bucket holding its light curves
+        bucket: positions in ids of the light curves in leaves, leaf by leaf
+    """
+
+    FIELDS = ('ids', 'vp', 'inside', 'outside', 'inside_max', 'outside_min', 'start', 'stop', 'bucket')
+
+    def __init__(self, ids, vp, inside, outside, inside_max, outside_min, start, stop, bucket):
+        self.ids = np.asarray(ids)
+        self.vp = np.asarray(vp)
+        self.inside = np.asarray(inside)
+        self.outside = np.asarray(outside)
+        self.inside_max = np.asarray(inside_max)
+        self.outside_min = np.asarray(outside_min)
+        self.start = np.asarray(start)
+        self.stop = np.asarray(stop)
+        self.bucket = np.asarray(bucket)
+        self._id_set = set(self.ids.tolist())
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, ts_id):
+        return ts_id in self._id_set
+
+    @classmethod
+    def build(cls, corpus, leaf_size=LEAF_SIZE, seed=None):
+        """
+        Builds a tree over all the light curves currently in corpus.
+
+        Args:
+            corpus: Corpus of the light curves to index
+            leaf_size: largest number of light curves kept in a leaf
+            seed: seed for picking the vantage points, for a reproducible tree
+        Returns:
+            VPTree
+        """
+        rand = random.Random(seed)
+        ids = list(corpus.ids)
+        rows = corpus.rows(ids)
+        values, spectra, self_norms = corpus.values, corpus.spectra, corpus.self_norms
+
+        vp, inside, outside, inside_max, outside_min, start, stop = [], [], [], [], [], [], []
+        bucket = []
+
+        def new_node():
+            for field in (vp, inside, outside, start, stop):
+                field.append(-1)
+            inside_max.append(0.)
+            outside_min.append(0.)
+            return len(vp) - 1
+
+        # (node number, positions in ids of the light curves below it)
+        root = new_node()
+        stack = [(root, np.arange(len(ids)))] if ids else []
+        while stack:
+            node, items = stack.pop()
+            if len(items) <= leaf_size:
+                start[node], stop[node] = len(bucket), len(bucket) + len(items)
+                bucket.extend(items.tolist())
+                continue
+
+            # pick a vantage point, and split the rest at their median distance to it
+            pick = rand.randrange(len(items))
+            vp[node] = items[pick]
+            rest = np.delete(items, pick)
+            r = rows[rest]
+            dists = kernel_dist_many(values[rows[vp[node]]], values[r], corpus.mult,
+                                     spectra=spectra[r], self_norms=self_norms[r])
+            order = np.argsort(dists, kind='stable')
+            half = len(order) // 2
+            inside_max[node] = dists[order[half - 1]]
+            outside_min[node] = dists[order[half]]
+
+            inside[node], outside[node] = new_node(), new_node()
+            stack.append((inside[node], rest[order[:half]]))
+            stack.append((outside[node], rest[order[half:]]))
+
+        return cls(np.array(ids, dtype=str), vp, inside, outside, inside_max, outside_min, start, stop,
+                   np.array(bucket, dtype=np.intp))
+
+    def save(self, path):
+        """Saves the tree to path as an .npz file"""
+        with open(path, 'wb') as f:
+            np.savez(f, **{field: getattr(self, field) for field in self.FIELDS})
+
+    @classmethod
+    def load(cls, path):
+        """Loads a tree saved with save()"""
+        with np.load(path, allow_pickle=False) as data:
+            return cls(*[data[field] for field in cls.FIELDS])
+
+    def nearest(self, corpus, s_ts, k):
+        """
+        Finds the k light curves closest to a standardized time series.
+
+        Nodes are visited best first, in order of the lower bound on the distance
+        to anything below them, and the search stops once that bound is beyond the
+        k-th best distance so far. Light curves added to the corpus after the tree
+        was built are scored directly, so the result is exact either way.
+
+        Args:
+            corpus: Corpus the tree was built over (or a later version of it)
+            s_ts: standardized time series to measure from
+            k: number of closest light curves to return
+        Returns:
+            List of (distance, ts_id) tuples for the k closest, closest first
+        """
+        # max-heap of the best k so far, as (-distance, ts_id)
+        best = []
+        kth_best = lambda: -best[0][0] if len(best) == k else np.inf
+
+        def consider(dists, ts_ids):
+            for dist, ts_id in zip(dists, ts_ids):
+                if len(best) < k:
+                    heapq.heappush(best, (-dist, ts_id))
+                elif dist < kth_best():
+                    heapq.heapreplace(best, (-dist, ts_id))
+
+        if len(corpus) != len(self):
+            unindexed = [ts_id for ts_id in corpus.ids if ts_id not in self]
+            if unindexed:
+                consider(corpus.kernel_dists(s_ts, unindexed), unindexed)
+
+        # min-heap of (lower bound, node number)
+        queue = [(0., 0)] if len(self.ids) else []
+        while queue:
+            bound, node = heapq.heappop(queue)
+            if bound > kth_best() + BOUND_SLACK:
+                break
+            if self.vp[node] < 0:
+                ts_ids = self.ids[self.bucket[self.start[node]:self.stop[node]]].tolist()
+                consider(corpus.kernel_dists(s_ts, ts_ids), ts_ids)
+                continue
+
+            vp_id = str(self.ids[self.vp[node]])
+            d = corpus.kernel_dists(s_ts, [vp_id])[0]
+            consider([d], [vp_id])
+            heapq.heappush(queue, (max(bound, d - self.inside_max[node]), self.inside[node]))
+            heapq.heappush(queue, (max(bound, self.outside_min[node] - d), self.outside[node]))
+
+        return sorted((-neg_dist, ts_id) for neg_dist, ts_id in best)
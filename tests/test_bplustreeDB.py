@@ -0,0 +1,115 @@
+from cs207project.rbtree.bplustreeDB import connect, PAGE_SIZE, MAX_ENTRY_SIZE
+from pytest import raises
+import random
+import os
+
+DB_NAME = "DELETEME_bplus.dbdb"
+
+def purge_demo_data():
+    try:
+        os.remove(DB_NAME)
+    except:
+        pass
+
+def gen_random_data(n):
+    """Fill a database with n random float keys; returns the expected sorted items"""
+    purge_demo_data()
+    random.seed(207)
+    items = {}
+    db = connect(DB_NAME)
+    for i in range(n):
+        key = random.random()
+        items[key] = "ts_datafile_%d" % i
+        db.set(key, items[key])
+    db.commit()
+    db.close()
+    return sorted(items.items())
+
+def test_small_tree():
+    purge_demo_data()
+    db = connect(DB_NAME)
+    for key, val in [(8, "eight"), (3, "three"), (10, "ten"), (1, "one"), (3, "THREE")]:
+        db.set(key, val)
+    db.commit()
+    db.close()
+
+    db = connect(DB_NAME)
+    assert db.get(3) == "THREE"
+    assert db.get_min() == "one"
+    assert db.chop(8) == [(1, "one"), (3, "THREE"), (8, "eight")]
+    with raises(KeyError):
+        db.get(4)
+    db.close()
+    purge_demo_data()
+
+def test_commit_necessary():
+    purge_demo_data()
+    db = connect(DB_NAME)
+    db.set(1, "one")
+    db.close()
+    db = connect(DB_NAME)
+    with raises(KeyError):
+        db.get(1)
+    with raises(KeyError):
+        db.get_min()
+    assert db.chop(10) == []
+    db.close()
+    purge_demo_data()
+
+def test_many_pages():
+    items = gen_random_data(3000)
+    db = connect(DB_NAME, cache_size=50)
+    # the tree spans many pages, all page aligned
+    assert os.path.getsize(DB_NAME) % PAGE_SIZE == 0
+    assert os.path.getsize(DB_NAME) > 10 * PAGE_SIZE
+    assert list(db.range()) == items
+    assert list(db.range(reverse=True)) == items[::-1]
+    for key, val in items[::100]:
+        assert db.get(key) == val
+    assert db.get_min() == items[0][1]
+
+    lo, hi = items[500][0], items[2500][0]
+    assert list(db.range(lo, hi)) == items[500:2501]
+    assert list(db.range(lo - 1e-9, hi + 1e-9, reverse=True)) == items[500:2501][::-1]
+    assert db.chop(hi) == items[:2501]
+    assert db.cache_info()['hits'] > 0
+    db.close()
+    purge_demo_data()
+
+def test_mmap_reads():
+    items = gen_random_data(500)
+    db = connect(DB_NAME, use_mmap=True)
+    assert list(db.range()) == items
+    db.set(2.0, "two")
+    db.commit()
+    assert db.get(2.0) == "two"
+    db.close()
+    purge_demo_data()
+
+def test_string_keys_and_large_values():
+    purge_demo_data()
+    db = connect(DB_NAME)
+    words = ["key%04d" % i for i in range(1000)]
+    for word in words[::-1]:
+        db.set(word, word * 10)
+    with raises(ValueError):
+        db.set("too big", "x" * MAX_ENTRY_SIZE)
+    db.commit()
+    db.close()
+
+    db = connect(DB_NAME)
+    assert [k for k, v in db.range("key0100", "key0199")] == words[100:200]
+    assert db.get("key0999") == "key0999" * 10
+    db.close()
+    purge_demo_data()
+
+def test_get_many():
+    items = gen_random_data(2000)
+    db = connect(DB_NAME)
+    wanted = items[::7]
+    keys = [k for k, v in wanted] + [-1.0, 0.5, 2.0]
+    random.shuffle(keys)
+    assert db.get_many(keys) == dict(wanted)
+    assert db.get_many([]) == {}
+    db.close()
+    purge_demo_data()
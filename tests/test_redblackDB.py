@@ -1,5 +1,9 @@
-from cs207project.rbtree.redblackDB import connect
+from cs207project.rbtree.redblackDB import connect, compact, space_report, Storage, RedBlackNode, RedBlackNodeRef, ValueRef, Color, Stats
+import pickle
+from pytest import raises
 import os
+import multiprocessing
+import threading
 
 def gen_demo_data():
     # initialize database
@@ -90,3 +94,587 @@ def test_commit_necessary():
     purge_demo_data() 
 
 
+def test_node_encoding_round_trip():
+    # float, int and fallback (pickled) keys all survive encoding
+    for key in [0.25, 7, -2**63, 2**70, "seven", (1, 2)]:
+        node = RedBlackNode(RedBlackNodeRef(address=4096), key,
+            ValueRef(address=5000), RedBlackNodeRef(address=6000), Color.BLACK)
+        decoded = RedBlackNodeRef.bytes_to_referent(
+            RedBlackNodeRef.referent_to_bytes(node))
+        assert decoded.key == key
+        assert type(decoded.key) == type(key)
+        assert decoded.left_ref.address == 4096
+        assert decoded.value_ref.address == 5000
+        assert decoded.right_ref.address == 6000
+        assert decoded.color == Color.BLACK
+
+def test_node_encoding_keeps_counts():
+    for key in [0.25, 7, "seven"]:
+        node = RedBlackNode(RedBlackNodeRef(address=4096, count=3), key,
+            ValueRef(address=5000), RedBlackNodeRef(), Color.RED)
+        assert node.size == 4
+        decoded = RedBlackNodeRef.bytes_to_referent(
+            RedBlackNodeRef.referent_to_bytes(node))
+        assert decoded.key == key
+        assert decoded.left_ref.count == 3
+        assert decoded.right_ref.count == 0
+        assert decoded.size == 4
+    # without a count for a child the record is written in the uncounted format
+    node = RedBlackNode(RedBlackNodeRef(address=4096), 7,
+        ValueRef(address=5000), RedBlackNodeRef(), Color.RED)
+    assert node.size is None
+    decoded = RedBlackNodeRef.bytes_to_referent(RedBlackNodeRef.referent_to_bytes(node))
+    assert decoded.size is None
+
+def test_node_encoding_inline_values():
+    for key in [0.25, 7, "seven"]:
+        node = RedBlackNode(RedBlackNodeRef(address=4096, count=1), key,
+            ValueRef("ts_datafile_7"), RedBlackNodeRef(), Color.BLACK)
+        decoded = RedBlackNodeRef.bytes_to_referent(
+            RedBlackNodeRef.referent_to_bytes(node))
+        assert decoded.key == key
+        assert decoded.value_ref.address == 0
+        assert decoded.value_ref.get(None) == "ts_datafile_7"
+        assert decoded.left_ref.count == 1
+
+def test_node_encoding_reads_pickled_nodes():
+    # nodes written by the original pickle-based format are still readable
+    legacy = pickle.dumps({'left': 0, 'key': 1.5, 'value': 4096, 'right': 0,
+        'color': Color.RED})
+    node = RedBlackNodeRef.bytes_to_referent(legacy)
+    assert node.key == 1.5
+    assert node.value_ref.address == 4096
+    assert node.is_red()
+
+def test_string_keys():
+    purge_demo_data()
+    db = connect("DELETEME.dbdb")
+    for key in ["b", "a", "c"]:
+        db.set(key, key.upper())
+    db.commit()
+    db.close()
+    db = connect("DELETEME.dbdb")
+    assert db.get("a")=="A"
+    assert db.chop("b")==[("b", "B"), ("a", "A")]
+    db.close()
+    purge_demo_data()
+
+def test_node_cache_hits_across_refreshes():
+    gen_demo_data()
+    db = connect("DELETEME.dbdb", cache_size=100)
+    assert db.chop(6)==[(6, u'six'), (1, u'one'), (3, u'three'), (4, u'four')]
+    misses = db.cache_info()['misses']
+    assert db.chop(6)==[(6, u'six'), (1, u'one'), (3, u'three'), (4, u'four')]
+    info = db.cache_info()
+    assert info['misses']==misses
+    assert info['hits'] > 0
+    db.close()
+    purge_demo_data()
+
+def test_node_cache_is_bounded():
+    gen_demo_data()
+    db = connect("DELETEME.dbdb", cache_size=3)
+    assert [db.get(k) for k in [1, 4, 7, 14]]==["one", "four", "seven", "fourteen"]
+    assert db.cache_info()['nodes']==3
+    db.close()
+
+    db = connect("DELETEME.dbdb", cache_bytes=100)
+    db.chop(100)
+    info = db.cache_info()
+    assert 0 < info['bytes'] <= 100
+    db.close()
+
+    db = connect("DELETEME.dbdb")
+    assert db.cache_info() is None
+    db.close()
+    purge_demo_data()
+
+def test_mmap_reads():
+    gen_demo_data()
+    db = connect("DELETEME.dbdb", use_mmap=True)
+    assert db.get(13)=="thirteen"
+    assert db.chop(6)==[(6, u'six'), (1, u'one'), (3, u'three'), (4, u'four')]
+
+    # a commit through another handle grows the file past the mapped length
+    writer = connect("DELETEME.dbdb")
+    writer.set(20, "twenty")
+    writer.commit()
+    writer.close()
+    assert db.get(20)=="twenty"
+
+    # our own writes are visible too
+    db.set(21, "twenty-one")
+    db.commit()
+    assert db.get(21)=="twenty-one"
+    assert db.get(1)=="one"
+    db.close()
+    purge_demo_data()
+
+def check_red_black(db):
+    """Returns black height of the tree, asserting red-black invariants hold"""
+    tree = db._tree
+    def black_height(node):
+        if node is None:
+            return 1
+        left, right = tree.left(node), tree.right(node)
+        if node.is_red():
+            assert left is None or left.is_black()
+            assert right is None or right.is_black()
+        lh, rh = black_height(left), black_height(right)
+        assert lh == rh
+        return lh + (1 if node.is_black() else 0)
+    root = tree._follow(tree._tree_ref)
+    assert root is None or root.is_black()
+    return black_height(root)
+
+def test_bulk_load():
+    for n in [0, 1, 2, 3, 4, 7, 8, 100]:
+        purge_demo_data()
+        db = connect("DELETEME.dbdb")
+        db.bulk_load((float(i), str(i)) for i in range(n))
+        db.commit()
+        db.close()
+
+        db = connect("DELETEME.dbdb")
+        check_red_black(db)
+        if n:
+            assert sorted(db.chop(n)) == [(float(i), str(i)) for i in range(n)]
+        for i in range(n):
+            assert db.get(float(i)) == str(i)
+        # set() still works on top of a bulk loaded tree
+        db.set(2.5, "2.5")
+        check_red_black(db)
+        db.close()
+    purge_demo_data()
+
+def test_bulk_load_merges_existing():
+    gen_demo_data()
+    db = connect("DELETEME.dbdb")
+    db.bulk_load([(0, "zero"), (2, "two"), (2, "TWO"), (10, "TEN"), (20, "twenty")])
+    db.commit()
+    db.close()
+
+    db = connect("DELETEME.dbdb")
+    check_red_black(db)
+    assert sorted(db.chop(100)) == [(0, "zero"), (1, "one"), (2, "TWO"), (3, "three"),
+        (4, "four"), (6, "six"), (7, "seven"), (8, "eight"), (10, "TEN"),
+        (13, "thirteen"), (14, "fourteen"), (20, "twenty")]
+    with raises(ValueError):
+        db.bulk_load([(2, "two"), (1, "one")])
+    db.close()
+    purge_demo_data()
+
+def test_range():
+    gen_demo_data()
+    db = connect("DELETEME.dbdb")
+    keys = [1, 3, 4, 6, 7, 8, 10, 13, 14]
+    assert [k for k, v in db.range()] == keys
+    assert [k for k, v in db.range(reverse=True)] == keys[::-1]
+    assert list(db.range(4, 8)) == [(4, "four"), (6, "six"), (7, "seven"), (8, "eight")]
+    assert [k for k, v in db.range(4.5, 12, reverse=True)] == [10, 8, 7, 6]
+    assert [k for k, v in db.range(lo=9)] == [10, 13, 14]
+    assert [k for k, v in db.range(hi=3.5)] == [1, 3]
+    assert list(db.range(15, 20)) == []
+    assert list(db.range(8, 4)) == []
+
+    # results are produced lazily
+    it = db.range(3)
+    assert next(it) == (3, "three")
+    assert next(it) == (4, "four")
+    db.close()
+    purge_demo_data()
+
+def test_batch():
+    gen_demo_data()
+    reader = connect("DELETEME.dbdb")
+    db = connect("DELETEME.dbdb")
+    with db.batch():
+        for key in range(20, 30):
+            db.set(key, str(key))
+            db.commit() # deferred until the batch ends
+        with raises(KeyError):
+            reader.get(20)
+        assert db.get(25)=="25"
+    assert reader.get(20)=="20"
+    assert reader.get(1)=="one"
+    db.close()
+    reader.close()
+
+    # a failing batch leaves nothing behind
+    size = os.path.getsize("DELETEME.dbdb")
+    db = connect("DELETEME.dbdb")
+    with raises(RuntimeError):
+        with db.batch():
+            db.set(40, "forty")
+            db.bulk_load([(41, "forty-one")])
+            raise RuntimeError
+    assert os.path.getsize("DELETEME.dbdb") == size
+    with raises(KeyError):
+        db.get(40)
+    db.set(50, "fifty")
+    db.commit()
+    db.close()
+
+    db = connect("DELETEME.dbdb")
+    assert db.get(50)=="fifty"
+    with raises(KeyError):
+        db.get(41)
+    db.close()
+    purge_demo_data()
+
+def test_concurrent_writers():
+    gen_demo_data()
+    db1 = connect("DELETEME.dbdb")
+    db2 = connect("DELETEME.dbdb")
+    # neither set() takes the lock, so interleaving them does not block
+    db1.set(100, "a")
+    db2.set(200, "b")
+    assert db1.get(100)=="a"
+    with raises(KeyError):
+        db1.get(200)
+    db2.commit()
+    # db1 replays its set on top of db2's commit instead of losing it
+    db1.commit()
+    assert db1.get(200)=="b"
+    db1.close()
+    db2.close()
+
+    db = connect("DELETEME.dbdb")
+    assert db.get(100)=="a"
+    assert db.get(200)=="b"
+    assert db.get(1)=="one"
+    check_red_black(db)
+    db.close()
+    purge_demo_data()
+
+def test_snapshot():
+    gen_demo_data()
+    db = connect("DELETEME.dbdb")
+    writer = connect("DELETEME.dbdb")
+    snap = db.snapshot()
+    writer.set(1, "uno")
+    writer.set(100, "hundred")
+    writer.commit()
+    assert snap.get(1)=="one"
+    with raises(KeyError):
+        snap.get(100)
+    assert [k for k, v in snap.range(90)] == []
+    assert db.get(1)=="uno"
+    assert db.snapshot().get(100)=="hundred"
+    writer.close()
+    db.close()
+    with raises(ValueError):
+        snap.get(1)
+    purge_demo_data()
+
+def test_durability():
+    gen_demo_data()
+    for durability in ('none', 'flush', 'fsync'):
+        db = connect("DELETEME.dbdb", durability=durability)
+        db.set(100, durability)
+        db.commit()
+        db.close()
+        db = connect("DELETEME.dbdb")
+        assert db.get(100)==durability
+        db.close()
+    with raises(ValueError):
+        connect("DELETEME.dbdb", durability="sometimes")
+    purge_demo_data()
+
+def read_in_other_process(dbname, key, result):
+    db = connect(dbname)
+    result.put(db.get(key))
+    db.close()
+
+def test_rollback_with_cache():
+    gen_demo_data()
+    db = connect("DELETEME.dbdb", cache_size=1000)
+    with raises(RuntimeError):
+        with db.batch():
+            db.bulk_load([(float(i), "old%02d" % i) for i in range(20)])
+            # read back from the append buffer, and cached
+            assert db.get(5.0)=="old05"
+            raise RuntimeError
+    # the next batch is written at the same addresses
+    with db.batch():
+        db.bulk_load([(float(i), "new%02d" % i) for i in range(20)])
+    assert db.get(5.0)=="new05"
+    db.close()
+    db = connect("DELETEME.dbdb")
+    assert db.get(5.0)=="new05"
+    db.close()
+    purge_demo_data()
+
+def test_group_commit():
+    gen_demo_data()
+    reader = connect("DELETEME.dbdb")
+    db = connect("DELETEME.dbdb", durability='group', group_window=3600, stats=True)
+    db.reset_stats()
+    for key in range(100, 110):
+        db.set(key, str(key))
+        db.commit()
+    # every commit is published at once, but only the first was fsynced, so
+    # the later ones have a root to fall back to
+    assert db.get(105)=="105"
+    assert reader.get(109)=="109"
+    assert db.stats()['fsyncs'] == 2
+    assert not db._storage.locked
+    db.sync()
+    assert db.stats()['fsyncs'] == 4
+    db.sync()
+    assert db.stats()['fsyncs'] == 4
+
+    # the lock is not held between commits, so another process can open the db and read
+    db.set(200, "two hundred")
+    db.commit()
+    result = multiprocessing.Queue()
+    other = multiprocessing.Process(target=read_in_other_process, args=("DELETEME.dbdb", 200, result))
+    other.start()
+    other.join(10)
+    alive = other.is_alive()
+    if alive:
+        other.terminate()
+    assert not alive
+    assert result.get(timeout=1)=="two hundred"
+
+    # a failed batch does not affect what was committed before it
+    with raises(RuntimeError):
+        with db.batch():
+            db.set(201, "lost")
+            raise RuntimeError
+    assert reader.get(200)=="two hundred"
+    with raises(KeyError):
+        reader.get(201)
+    # close fsyncs the rest
+    db.set(202, "two hundred and two")
+    db.commit()
+    stats = db._storage.stats
+    db.close()
+    assert stats.counters['fsyncs'] == 6
+    assert reader.get(202)=="two hundred and two"
+    reader.close()
+
+    # the time and size windows fsync at the commit that passes them
+    for window, size in [(0, 1 << 22), (3600, 1)]:
+        db = connect("DELETEME.dbdb", durability='group', group_window=window, group_bytes=size, stats=True)
+        db.reset_stats()
+        db.set(300, "three hundred")
+        db.commit()
+        assert db.stats()['fsyncs'] == 2
+        db.close()
+    purge_demo_data()
+
+def test_group_commit_recovery():
+    gen_demo_data()
+    db = connect("DELETEME.dbdb", durability='group', group_window=3600)
+    db.set(100, "hundred")
+    db.commit()
+    db.sync()
+    durable_end = os.path.getsize("DELETEME.dbdb")
+    db.set(101, "hundred and one")
+    db.commit()
+    with open("DELETEME.dbdb", "rb") as f:
+        data = f.read()
+
+    # an OS crash loses the records appended after the fsync, but not the superblock
+    for name, lost in [("DELETEME_intact.dbdb", False), ("DELETEME_crashed.dbdb", True)]:
+        with open(name, "wb") as f:
+            f.write(data[:durable_end])
+            tail = data[durable_end:]
+            f.write(b'\x00' * len(tail) if lost else tail)
+        crashed = connect(name)
+        assert crashed.get(100)=="hundred"
+        if lost:
+            # back at the last fsynced root, which never points to lost records
+            with raises(KeyError):
+                crashed.get(101)
+            crashed.set(101, "again")
+            crashed.commit()
+            assert crashed.get(101)=="again"
+        else:
+            assert crashed.get(101)=="hundred and one"
+        crashed.close()
+        os.remove(name)
+    db.close()
+    purge_demo_data()
+
+def test_append_buffer():
+    purge_demo_data()
+    f = open("DELETEME.dbdb", "w+b")
+    storage = Storage(f, buffer_bytes=100)
+    records = [str(i).encode() * 10 for i in range(30)]
+    addresses = [storage.write(record) for record in records]
+    # the buffer was flushed in chunks, and every record reads back wherever it is
+    assert storage.size > Storage.SUPERBLOCK_SIZE
+    assert addresses[0] == Storage.SUPERBLOCK_SIZE
+    assert [storage.read(address) for address in addresses] == records
+    storage.commit_root_address(addresses[-1])
+    assert not storage.locked
+    assert storage.size == addresses[-1] + Storage.INTEGER_LENGTH + len(records[-1])
+    assert [storage.read(address) for address in addresses] == records
+    assert storage.get_root_address() == addresses[-1]
+    storage.close()
+    purge_demo_data()
+
+def test_stats():
+    gen_demo_data()
+    db = connect("DELETEME.dbdb")
+    assert db.stats() is None
+    db.close()
+
+    db = connect("DELETEME.dbdb", cache_size=100, stats=True)
+    db.get(14)
+    db.get(14)
+    stats = db.stats()
+    # small values are read with their node, and the second get reads nothing
+    assert stats['reads'] == stats['node_decodes']
+    assert stats['bytes_read'] > 0
+    assert stats['cache_hits'] > 0 and stats['cache_misses'] == stats['node_decodes']
+    assert sum(stats['latency_us']['get'].values()) == 2
+    assert list(stats['depth'].values()) == [2]
+    db.reset_stats()
+    stats = db.stats()
+    assert stats['reads'] == stats['lock_waits'] == stats['cache_hits'] == 0
+    assert stats['latency_us'] == {}
+    db.set(100, "hundred")
+    db.commit()
+    stats = db.stats()
+    # nobody else held the lock
+    assert stats['commits'] == 1 and stats['lock_waits'] == 0
+    assert stats['writes'] > 0 and stats['flushes'] == 1
+    assert set(stats['latency_us']) == {'set', 'commit'}
+
+    # a lock held by another connection is waited for, and counted
+    other = connect("DELETEME.dbdb")
+    other._storage.lock()
+    release = threading.Timer(0.05, other._storage.unlock)
+    release.start()
+    db.set(101, "hundred and one")
+    db.commit()
+    release.join()
+    stats = db.stats()
+    assert stats['lock_waits'] == 1 and stats['lock_wait_seconds'] > 0
+    other.close()
+    db.close()
+
+    # a latency goes in the smallest power of two microseconds at least as long
+    stats = Stats()
+    for seconds in [0, 1e-6, 2e-6, 3e-6, 4e-6, 4.5e-6, 1024e-6]:
+        stats.record('get', seconds)
+    assert stats.latencies['get'] == {1: 2, 2: 1, 4: 2, 8: 1, 1024: 1}
+    purge_demo_data()
+
+def test_count_range_and_nearest_keys():
+    gen_demo_data()
+    db = connect("DELETEME.dbdb")
+    keys = [1, 3, 4, 6, 7, 8, 10, 13, 14]
+    for lo, hi in [(None, None), (4, 8), (5, 9), (0, 100), (14, 14), (15, 20), (8, 4), (None, 6), (9, None)]:
+        assert db.count_range(lo, hi) == len(list(db.range(lo, hi)))
+    assert db.count_range() == len(keys)
+    # ties go to the larger key
+    assert db.nearest_keys(7, 3) == [7, 8, 6]
+    assert db.nearest_keys(11.9, 4) == [13, 10, 14, 8]
+    assert db.nearest_keys(0, 2) == [1, 3]
+    assert db.nearest_keys(5, 100) == sorted(keys, key=lambda k: (abs(k - 5), -k))
+    nearest = db.iter_nearest(11.9)
+    assert next(nearest) == (13, u'thirteen')
+    assert [k for k, _ in nearest] == [10, 14, 8, 7, 6, 4, 3, 1]
+    assert [k for k, _ in db.snapshot().iter_nearest(2)] == [3, 1, 4, 6, 7, 8, 10, 13, 14]
+    db.close()
+
+    # subtrees read from records without counts are counted by walking them
+    db = connect("DELETEME.dbdb")
+    root = db._tree._follow(db._tree._tree_ref)
+    assert db._tree._count(RedBlackNodeRef(address=root.left_ref.address)) == root.left_ref.count == 3
+    db.close()
+    purge_demo_data()
+
+def test_inline_values():
+    gen_demo_data()
+    db = connect("DELETEME.dbdb", stats=True)
+    db.set(100, "x" * 100)
+    db.commit()
+    db.reset_stats()
+    # small values come with their node, so only the nodes are read
+    assert db.chop(6)==[(6, u'six'), (1, u'one'), (3, u'three'), (4, u'four')]
+    stats = db.stats()
+    assert stats['reads'] == stats['node_decodes']
+    db.close()
+
+    db = connect("DELETEME.dbdb", stats=True)
+    assert db.get(100) == "x" * 100
+    assert db.stats()['reads'] == db.stats()['node_decodes'] + 1
+    db.close()
+
+    # with inlining off every value has a record of its own
+    db = connect("DELETEME.dbdb", stats=True, inline_values=0)
+    db.set(200, "two hundred")
+    db.commit()
+    db.close()
+    db = connect("DELETEME.dbdb", stats=True)
+    assert db.get(200) == "two hundred"
+    assert db.stats()['reads'] == db.stats()['node_decodes'] + 1
+    db.close()
+    purge_demo_data()
+
+def test_compact():
+    gen_demo_data()
+    # every commit leaves the previous root-to-leaf path behind as dead records
+    for i in range(20):
+        db = connect("DELETEME.dbdb")
+        db.set(i % 5, "v%d" % i)
+        db.commit()
+        db.close()
+    expected = [(0, "v15"), (1, "v16"), (2, "v17"), (3, "v18"), (4, "v19"),
+        (6, "six"), (7, "seven"), (8, "eight"), (10, "ten"), (13, "thirteen"), (14, "fourteen")]
+
+    report = space_report("DELETEME.dbdb")
+    assert report['file_bytes'] == os.path.getsize("DELETEME.dbdb")
+    assert report['live_bytes'] + report['dead_bytes'] == report['file_bytes']
+    assert report['live_ratio'] < 0.9
+
+    assert compact("DELETEME.dbdb", min_live_ratio=0.01) == False
+    reader = connect("DELETEME.dbdb")
+    writer = connect("DELETEME.dbdb")
+    assert compact("DELETEME.dbdb") == True
+
+    new_report = space_report("DELETEME.dbdb")
+    assert new_report['file_bytes'] < report['file_bytes']
+    assert new_report['live_ratio'] == 1.0
+    db = connect("DELETEME.dbdb")
+    assert list(db.range()) == expected
+    check_red_black(db)
+    db.close()
+
+    # connections to the old file can still read, but not write
+    assert list(reader.range()) == expected
+    reader.close()
+    writer.set(100, "hundred")
+    with raises(IOError):
+        writer.commit()
+    writer.close()
+
+    # changing the working dir does not make a relative path look replaced
+    db = connect("DELETEME.dbdb")
+    cwd = os.getcwd()
+    os.chdir(os.pardir)
+    try:
+        db.set(100, "hundred")
+        db.commit()
+        db.close()
+    finally:
+        os.chdir(cwd)
+    db = connect("DELETEME.dbdb")
+    assert db.get(100)=="hundred"
+    db.close()
+    purge_demo_data()
+
+def test_get_many():
+    gen_demo_data()
+    db = connect("DELETEME.dbdb")
+    assert db.get_many([14, 1, 5, 7, 7, 100]) == {1: "one", 7: "seven", 14: "fourteen"}
+    assert db.get_many([]) == {}
+    keys = [1, 3, 4, 6, 7, 8, 10, 13, 14]
+    assert db.get_many(keys) == dict((k, db.get(k)) for k in keys)
+    db.close()
+    purge_demo_data()
@@ -4,20 +4,26 @@
 import os
 import random
 import sys
+import multiprocessing
+import numpy as np
 
 from pytest import raises
 #from mock import patch
 from unittest.mock import patch
 
-from cs207project.tsrbtreedb.crosscorr import kernel_corr, kernel_dist, standardize, ccor
+from cs207project.tsrbtreedb.crosscorr import kernel_corr, kernel_dist, standardize, ccor, kernel_dist_many, kernel_norms, spectrum
 import cs207project.tsrbtreedb.makelcs as makelcs
 from cs207project.tsrbtreedb.makelcs import clear_dir, tsmaker, random_ts
 import cs207project.tsrbtreedb.genvpdbs as genvpdbs
 import cs207project.tsrbtreedb.simsearch as simsearch
+import cs207project.tsrbtreedb.knngraph as knngraph
 import cs207project.tsrbtreedb.simsearchutil as simsearchutil
 from cs207project.storagemanager.filestoragemanager import FileStorageManager
 import cs207project.tsrbtreedb.unbalancedDB as unbalancedDB
-from cs207project.tsrbtreedb.settings import TEMP_DIR, LIGHT_CURVES_DIR, DB_DIR, SAMPLE_DIR
+from cs207project.rbtree.redblackDB import connect
+from cs207project.tsrbtreedb.corpus import get_corpus, clear_corpora
+from cs207project.tsrbtreedb.vptree import VPTree
+from cs207project.tsrbtreedb.settings import TEMP_DIR, LIGHT_CURVES_DIR, DB_DIR, SAMPLE_DIR, VPTREE_FN
 
 def test_value_and_file_asserts():
     """Confirm that we raise value error when attempting to load non-existent time series """
@@ -82,6 +88,260 @@ def test_simsearch():
     simsearchutil.sim_search(demo_fp,db_temp_dir,lc_temp_dir,False)
 
 
+def test_add_many_ts_to_vpdbs():
+    lc_temp_dir = TEMP_DIR + LIGHT_CURVES_DIR
+    db_temp_dir = TEMP_DIR + DB_DIR
+
+    fsm = FileStorageManager(lc_temp_dir)
+    new_ts = [tsmaker(0.5, 0.1, random.uniform(0,10)) for i in range(3)]
+    new_fns = []
+    for ts in new_ts:
+        ts_fn = fsm.get_unique_id()
+        fsm.store(ts_fn, ts)
+        new_fns.append(ts_fn)
+    simsearch.add_many_ts_to_vpdbs(new_ts, new_fns, db_temp_dir, lc_temp_dir)
+
+    # every vantage point db now has an entry for each of the new time series
+    for vp_fn in simsearch.load_vp_lcs(db_temp_dir, lc_temp_dir):
+        db = connect(db_temp_dir + vp_fn + ".dbdb")
+        stored_fns = [ts_fn for _, ts_fn in db.range()]
+        db.close()
+        assert len(stored_fns) == 100 - 1 + 3
+        assert all(ts_fn in stored_fns for ts_fn in new_fns)
+
+
+def test_worker_pool():
+    lc_temp_dir = TEMP_DIR + LIGHT_CURVES_DIR
+    db_temp_dir = TEMP_DIR + DB_DIR
+
+    pool = simsearch.start_worker_pool(2)
+    assert simsearch.start_worker_pool() is pool
+    try:
+        vp_dict = simsearch.load_vp_lcs(db_temp_dir, lc_temp_dir)
+        for _ in range(2):
+            ts = tsmaker(0.5, 0.1, random.uniform(0,10))
+            fsm = FileStorageManager(lc_temp_dir)
+            ts_fn = fsm.get_unique_id()
+            fsm.store(ts_fn, ts)
+            # workers that loaded the light curves before this one was stored still find it
+            simsearch.add_ts_to_vpdbs(ts, ts_fn, db_temp_dir, lc_temp_dir)
+            vp_t = simsearch.find_closest_vp(vp_dict, ts)
+            _, existing_id = simsearch.search_vpdb_for_n(vp_t, ts, db_temp_dir, lc_temp_dir, 3)
+            assert existing_id == int(ts_fn.replace('ts_datafile_', ''))
+    finally:
+        simsearch.shutdown_worker_pool()
+    assert simsearch._pool is None
+
+
+def test_corpus():
+    lc_temp_dir = TEMP_DIR + LIGHT_CURVES_DIR
+    db_temp_dir = TEMP_DIR + DB_DIR
+
+    corpus = get_corpus(lc_temp_dir)
+    assert get_corpus(lc_temp_dir) is corpus
+    fsm = FileStorageManager(lc_temp_dir)
+    assert len(corpus) == len(fsm.get_ids())
+
+    # distances match the one at a time calculation
+    s_ts = standardize(tsmaker(0.5, 0.1, random.uniform(0,10)))
+    ts_ids = sorted(fsm.get_ids())[:20]
+    expected = [kernel_dist(standardize(fsm.get(ts_id)), s_ts) for ts_id in ts_ids]
+    assert np.allclose(corpus.kernel_dists(s_ts, ts_ids), expected)
+    assert corpus.kernel_dists(standardize(fsm.get(ts_ids[0])), ts_ids[:1])[0] < .00001
+
+    # added time series are picked up without reloading
+    ts = tsmaker(0.5, 0.1, random.uniform(0,10))
+    ts_fn = fsm.get_unique_id()
+    fsm.store(ts_fn, ts)
+    simsearch.add_ts_to_vpdbs(ts, ts_fn, db_temp_dir, lc_temp_dir)
+    assert ts_fn in corpus and len(corpus) == len(fsm.get_ids())
+    vp_t = simsearch.find_closest_vp(simsearch.list_vps(db_temp_dir), ts, lc_temp_dir)
+    vp_t_disk = simsearch.find_closest_vp(simsearch.load_vp_lcs(db_temp_dir, lc_temp_dir), ts)
+    assert vp_t[0] == vp_t_disk[0] and np.isclose(vp_t[1], vp_t_disk[1])
+    _, existing_id = simsearch.search_vpdb_for_n(vp_t, ts, db_temp_dir, lc_temp_dir, 3)
+    assert existing_id == int(ts_fn.replace('ts_datafile_', ''))
+
+    with raises(ValueError):
+        corpus.rows(['ts_datafile_not_stored'])
+
+
+def test_corpus_nearest():
+    lc_temp_dir = TEMP_DIR + LIGHT_CURVES_DIR
+    db_temp_dir = TEMP_DIR + DB_DIR
+
+    corpus = get_corpus(lc_temp_dir)
+    vp_fns = sorted(simsearch.list_vps(db_temp_dir))
+    table = corpus.vp_table(vp_fns)
+    assert table.shape == (len(corpus), len(vp_fns))
+    row = corpus.rows(vp_fns[:1])[0]
+    assert table[row, 0] < .00001
+
+    for _ in range(5):
+        s_ts = standardize(tsmaker(0.5, 0.1, random.uniform(0,10)))
+        before = corpus.evaluations
+        expected = corpus.nearest(s_ts, corpus.ids, 5)
+        full_evaluations = corpus.evaluations - before
+
+        before = corpus.evaluations
+        pruned = corpus.nearest(s_ts, corpus.ids, 5, vp_fns)
+        assert [ts_id for _, ts_id in pruned] == [ts_id for _, ts_id in expected]
+        assert np.allclose([d for d, _ in pruned], [d for d, _ in expected])
+        assert corpus.evaluations - before <= full_evaluations + len(vp_fns)
+
+    # many queries at once give the same answers as one at a time
+    queries = [standardize(tsmaker(0.5, 0.1, random.uniform(0,10))) for _ in range(7)]
+    q_values = np.array([q.values() for q in queries])
+    for batch in [corpus.nearest_many(q_values, corpus.ids, 4, vp_fns, max_pairs=50),
+                  corpus.nearest_many(q_values, corpus.ids, 4)]:
+        for q, nearest in zip(queries, batch):
+            expected = corpus.nearest(q, corpus.ids, 4)
+            assert [ts_id for _, ts_id in nearest] == [ts_id for _, ts_id in expected]
+            assert np.allclose([d for d, _ in nearest], [d for d, _ in expected])
+    dist_matrix = corpus.kernel_dist_matrix(q_values, vp_fns)
+    assert np.allclose(dist_matrix[2], corpus.kernel_dists(queries[2], vp_fns))
+
+    # bounds for series stored by someone else since the table was built
+    ts = tsmaker(0.5, 0.1, random.uniform(0,10))
+    other_fsm = FileStorageManager(lc_temp_dir)
+    ts_fn = other_fsm.get_unique_id()
+    other_fsm.store(ts_fn, ts)
+    assert ts_fn not in corpus
+    s_ts = standardize(ts)
+    bounds = corpus.lower_bounds(corpus.kernel_dists(s_ts, vp_fns), [ts_fn], vp_fns)
+    assert ts_fn in corpus and bounds[0] < .00001
+    simsearch.add_ts_to_vpdbs(ts, ts_fn, db_temp_dir, lc_temp_dir)
+
+    # the table is extended when new series are added
+    ts = tsmaker(0.5, 0.1, random.uniform(0,10))
+    corpus.add('ts_datafile_not_stored', ts)
+    assert corpus.vp_table(vp_fns).shape == (len(corpus), len(vp_fns))
+    nearest = corpus.nearest(standardize(ts), corpus.ids, 1, vp_fns)
+    assert nearest[0][1] == 'ts_datafile_not_stored' and nearest[0][0] < .00001
+    clear_corpora()
+
+
+def test_find_nearest():
+    lc_temp_dir = TEMP_DIR + LIGHT_CURVES_DIR
+    db_temp_dir = TEMP_DIR + DB_DIR
+
+    corpus = get_corpus(lc_temp_dir)
+    vp_fns = simsearch.list_vps(db_temp_dir)
+    for k in [1, 3, 10]:
+        ts = tsmaker(0.5, 0.1, random.uniform(0,10))
+        vp_t = simsearch.find_closest_vp(vp_fns, ts, lc_temp_dir)
+        before = corpus.evaluations
+        nearest = simsearch.find_nearest(vp_t, ts, db_temp_dir, lc_temp_dir, k)
+        assert corpus.evaluations - before < len(corpus) + len(vp_fns)
+        # the same distances as scoring every light curve
+        expected = corpus.nearest(standardize(ts), corpus.ids, k)
+        assert len(nearest) == k
+        assert np.allclose([d for d, _ in nearest], [d for d, _ in expected])
+
+    # a stored time series is its own nearest neighbour
+    fsm = FileStorageManager(lc_temp_dir)
+    ts_fn = sorted(fsm.get_ids())[-1]
+    ts = fsm.get(ts_fn)
+    vp_t = simsearch.find_closest_vp(vp_fns, ts, lc_temp_dir)
+    dist, nearest_fn = simsearch.find_nearest(vp_t, ts, db_temp_dir, lc_temp_dir, 2)[0]
+    assert dist < .00001
+
+
+def store_in_other_process(ts, ts_fn, db_dir, lc_dir):
+    FileStorageManager(lc_dir).store(ts_fn, ts)
+    simsearch.add_ts_to_vpdbs(ts, ts_fn, db_dir, lc_dir)
+
+def test_vptree():
+    lc_temp_dir = TEMP_DIR + LIGHT_CURVES_DIR
+    db_temp_dir = TEMP_DIR + DB_DIR
+
+    # rebuild_lcs_dbs saved a tree along with the vantage point dbs
+    assert os.path.exists(db_temp_dir + VPTREE_FN)
+    assert len(simsearch.load_vptree(db_temp_dir)) == 100
+
+    corpus = get_corpus(lc_temp_dir)
+    tree = simsearch.build_vptree(db_temp_dir, lc_temp_dir, leaf_size=4)
+    assert len(tree) == len(corpus)
+    loaded = simsearch.load_vptree(db_temp_dir)
+    for field in VPTree.FIELDS:
+        assert np.array_equal(getattr(loaded, field), getattr(tree, field))
+    assert sorted(loaded.bucket.tolist() + [vp for vp in loaded.vp.tolist() if vp >= 0]) == list(range(len(tree)))
+
+    for k in [1, 5]:
+        s_ts = standardize(tsmaker(0.5, 0.1, random.uniform(0,10)))
+        nearest = loaded.nearest(corpus, s_ts, k)
+        expected = corpus.nearest(s_ts, corpus.ids, k)
+        assert np.allclose([d for d, _ in nearest], [d for d, _ in expected])
+
+    # light curves added after the tree was built are found too
+    ts = tsmaker(0.5, 0.1, random.uniform(0,10))
+    fsm = FileStorageManager(lc_temp_dir)
+    ts_fn = fsm.get_unique_id()
+    fsm.store(ts_fn, ts)
+    simsearch.add_ts_to_vpdbs(ts, ts_fn, db_temp_dir, lc_temp_dir)
+    n_closest, existing_id = simsearch.search_vptree_for_n(ts, db_temp_dir, lc_temp_dir, 3)
+    assert existing_id == int(ts_fn.replace('ts_datafile_', ''))
+    vp_t = simsearch.find_closest_vp(simsearch.list_vps(db_temp_dir), ts, lc_temp_dir)
+    n_closest_vpdb, _ = simsearch.search_vpdb_for_n(vp_t, ts, db_temp_dir, lc_temp_dir, 3)
+    assert np.allclose(sorted(n_closest), sorted(n_closest_vpdb))
+
+    # and so are light curves added by another process
+    ts = tsmaker(0.5, 0.1, random.uniform(0,10))
+    ts_fn = fsm.get_unique_id()
+    process = multiprocessing.Process(target=store_in_other_process, args=(ts, ts_fn, db_temp_dir, lc_temp_dir))
+    process.start()
+    process.join(60)
+    assert process.exitcode == 0 and ts_fn not in corpus
+    _, existing_id = simsearch.search_vptree_for_n(ts, db_temp_dir, lc_temp_dir, 3)
+    assert existing_id == int(ts_fn.replace('ts_datafile_', ''))
+
+    # rebuilding the vantage point dbs clears db_dir; the next search builds a
+    # new tree, which indexes the added light curves too
+    genvpdbs.create_vpdbs(10, lc_temp_dir, db_temp_dir)
+    assert not os.path.exists(db_temp_dir + VPTREE_FN)
+    with raises(FileNotFoundError):
+        simsearch.load_vptree(db_temp_dir)
+    _, existing_id = simsearch.search_vptree_for_n(ts, db_temp_dir, lc_temp_dir, 3)
+    assert existing_id == int(ts_fn.replace('ts_datafile_', ''))
+    assert len(simsearch.load_vptree(db_temp_dir)) == len(corpus)
+
+
+def test_knn_graph():
+    lc_temp_dir = TEMP_DIR + LIGHT_CURVES_DIR
+    graph_dir = TEMP_DIR + "knn_graph/"
+
+    n = knngraph.build_knn_graph(lc_temp_dir, graph_dir, k=4, block=16, max_pairs=200)
+    ids, neighbors, dists = knngraph.load_knn_graph(graph_dir)
+    corpus = get_corpus(lc_temp_dir)
+    assert n == len(ids) == len(corpus)
+    assert neighbors.shape == dists.shape == (n, 4)
+    assert neighbors.dtype == np.int32
+
+    for row in random.sample(range(n), 10):
+        assert row not in neighbors[row]
+        others = [ts_id for ts_id in corpus.ids if ts_id != ids[row]]
+        expected = corpus.nearest(corpus.values[corpus.rows([ids[row]])[0]], others, 4)
+        assert np.allclose(dists[row], [d for d, _ in expected], atol=1e-6)
+        assert list(np.diff(dists[row]) >= 0) == [True] * 3
+
+    # workers of a shared pool reload light curves regenerated under the same ids
+    small_lc_dir = TEMP_DIR + "knn_lcs/"
+    simsearch.start_worker_pool(2)
+    try:
+        for _ in range(2):
+            makelcs.make_lcs_wfm(40, small_lc_dir)
+            clear_corpora()
+            knngraph.build_knn_graph(small_lc_dir, graph_dir, k=3, block=8)
+            ids, neighbors, dists = knngraph.load_knn_graph(graph_dir)
+            corpus = get_corpus(small_lc_dir)
+            for row in range(len(ids)):
+                others = [ts_id for ts_id in corpus.ids if ts_id != ids[row]]
+                expected = corpus.nearest(corpus.values[corpus.rows([ids[row]])[0]], others, 3)
+                assert np.allclose(dists[row], [d for d, _ in expected], atol=1e-6)
+    finally:
+        simsearch.shutdown_worker_pool()
+    clear_corpora()
+
+
 def test_cmd_line_util():
     os.chdir('cs207project/tsrbtreedb')
 
@@ -118,6 +378,37 @@ def test_crosscorr():
     assert(kernel_corr(t1,t2) < 1)
     assert(kernel_corr(t1,t3) < 1)
 
+def test_kernel_dist_many():
+
+    t1 = standardize(tsmaker(0.5, 0.1, random.uniform(0,10)))
+    candidates = [standardize(tsmaker(0.5, 0.1, random.uniform(0,10))) for _ in range(10)]
+    candidates += [standardize(random_ts(0.5)), t1]
+    matrix = np.array([c.values() for c in candidates])
+
+    # one query against many gives the same distances as one pair at a time
+    dists = kernel_dist_many(t1, matrix)
+    assert np.allclose(dists, [kernel_dist(c, t1) for c in candidates])
+    assert dists[-1] < .00001
+
+    # precomputed spectra and self norms give the same answer
+    spectra = spectrum(matrix)
+    self_norms = kernel_norms(spectra, matrix.shape[1])
+    assert np.allclose(kernel_dist_many(t1, matrix, spectra=spectra, self_norms=self_norms), dists)
+    assert np.allclose(kernel_dist_many(t1.values(), matrix), dists)
+
+    # the real-input spectra give the same cross-correlation as the full FFT
+    full = np.fft.ifft(np.fft.fft(t1.values()) * np.conjugate(np.fft.fft(matrix[0]))).real / len(t1)
+    assert np.allclose(ccor(t1, candidates[0]), full)
+    assert np.allclose(ccor(t1.values(), matrix[0]), full)
+    assert np.allclose(kernel_dist(t1.values(), matrix[0]), kernel_dist(t1, candidates[0]))
+
+    with raises(ValueError):
+        kernel_dist_many(t1, np.array([standardize(random_ts(0.5,200)).values()]))
+    with raises(ValueError):
+        kernel_dist_many(t1, matrix + 1)
+    with raises(ValueError):
+        kernel_dist_many(tsmaker(0.5, 0.1, random.uniform(0,10)), matrix)
+
 def test_crosscorr_errors():
     """Test that we have checks for varies error conditions"""
 
@@ -212,6 +503,24 @@ def test_db_2():
     assert db.chop(6.1)==[(3, u'three'), (1, u'one'), (6, u'six'), (4, u'four')] # test chop on key out of database
     db.close()
 
+def test_db_sorted_inserts():
+    # sorted inserts make a chain deeper than the recursion limit
+    n = sys.getrecursionlimit() + 100
+    db_fname = TEMP_DIR + "test3.dbdb"
+    db = unbalancedDB.connect(db_fname)
+    for key in range(n):
+        db.set(key, str(key))
+    db.commit()
+    db.close()
+
+    db = unbalancedDB.connect(db_fname)
+    assert db.get(n - 1) == str(n - 1)
+    assert db.get_right(n - 2) == (n - 1, str(n - 1))
+    root = db._tree._follow(db._tree._tree_ref)
+    assert db._tree.traverse_in_order(root) == [(key, str(key)) for key in range(n)]
+    assert len(db.chop(n / 2)) == n // 2 + 1
+    db.close()
+
 def test_clear():
     """Clear test dir for tests"""
     clear_dir(TEMP_DIR,recreate=False)
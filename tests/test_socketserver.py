@@ -10,7 +10,7 @@ from pytest import raises
 
 from cs207project.tsrbtreedb.settings import LIGHT_CURVES_DIR, DB_DIR, TS_LENGTH, SAMPLE_DIR, TEMP_DIR, PORT
 from cs207project.tsrbtreedb.makelcs import clear_dir, tsmaker, random_ts
-from cs207project.tsrbtreedb.simsearch_interface import simsearch_by_id,rebuild_if_needed, get_by_id,add_ts,simsearch_by_ts
+from cs207project.tsrbtreedb.simsearch_interface import simsearch_by_id,rebuild_if_needed, get_by_id,add_ts,simsearch_by_ts,simsearch_many
 from cs207project.tsrbtreedb.crosscorr import kernel_corr, kernel_dist, standardize, ccor
 from cs207project.timeseries.arraytimeseries import ArrayTimeSeries
 
@@ -78,6 +78,23 @@ def test_add_ts():
 
     assert(add_ts(new_ts) == new_tsid)
 
+def test_simsearch_many():
+    stored = [get_by_id(75), get_by_id(100)]
+    new_ts = standardize(tsmaker(0.5, 0.1, random.uniform(0,10)))
+    results = simsearch_many(stored + [new_ts], 5)
+    assert [tsid for _, tsid in results] == [75, 100, -1]
+
+    # the same neighbours as searching one at a time
+    for (n_closest_dict, _), tsid in zip(results, [75, 100]):
+        expected = sorted(simsearch_by_id(tsid,5).items())
+        found = sorted(n_closest_dict.items())
+        assert [i for _, i in found] == [i for _, i in expected]
+        assert np.allclose([d for d, _ in found], [d for d, _ in expected])
+    assert len(results[2][0]) == 5
+
+    # an empty batch has no results
+    assert simsearch_many([], 5) == []
+
 def test_socket_server():
     # startup server on separate thread
     global serv